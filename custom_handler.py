@@ -9,44 +9,522 @@
 import os
 import sys
 import json
+import asyncio
 import time
+import threading
 import uuid
+import atexit
+import hashlib
+import contextlib
+import weakref
 import logging
+import functools
+import re
+import bisect
+from collections import OrderedDict, deque
 import requests
-from typing import Dict, List, Any, Optional, Iterator, AsyncIterator
+from requests.adapters import HTTPAdapter
+from typing import Dict, List, Any, Optional, Iterator, AsyncIterator, Protocol, Hashable, Set
 
-# 添加项目根目录到系统路径
-sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+# 添加项目根目录到系统路径（已存在时不重复插入）
+_project_root = os.path.abspath(os.path.dirname(__file__))
+if _project_root not in sys.path:
+    sys.path.insert(0, _project_root)
 
 # 导入LiteLLM相关模块
 import litellm
-from litellm import CustomLLM, completion, get_llm_provider
-from litellm.types.utils import GenericStreamingChunk, ModelResponse
+from litellm import CustomLLM
+from litellm.types.utils import GenericStreamingChunk, ModelResponse, Choices, Message, Usage
 
 # 设置日志
 logger = logging.getLogger(__name__)
 
+# JSON序列化：与adapter共用productAdapter.utils.json_utils（优先orjson，未安装时回退到标准库）
+from productAdapter.utils.json_utils import json_dumps as _json_dumps, json_loads as _json_loads
+
+# uvloop（libuv事件循环）：Windows或未安装时为None
+uvloop = None
+if sys.platform != "win32":
+    try:
+        import uvloop
+    except ImportError:
+        pass
+
+# 全局事件循环策略属于宿主应用，仅在显式开启 LITELLM_ADAPTER_UVLOOP=1 时替换为uvloop
+if uvloop is not None and os.environ.get("LITELLM_ADAPTER_UVLOOP") == "1":
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+# 同步streaming()桥接异步实现用的后台事件循环（守护线程内常驻，懒创建）
+_bg_loop: Optional[asyncio.AbstractEventLoop] = None
+_bg_loop_lock = threading.Lock()
+
+
+def _get_background_loop() -> asyncio.AbstractEventLoop:
+    """返回后台常驻事件循环，首次调用时在守护线程中启动。"""
+    global _bg_loop
+    if _bg_loop is None:
+        with _bg_loop_lock:
+            if _bg_loop is None:
+                # 后台循环由本模块独占，可用时总是使用uvloop
+                loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="custom-handler-loop", daemon=True).start()
+                _bg_loop = loop
+    return _bg_loop
+
+
+# 存活的MyCustomLLM实例（弱引用，不延长实例生命周期），进程退出时统一释放连接池
+_live_instances: "weakref.WeakSet[MyCustomLLM]" = weakref.WeakSet()
+
+
+def _close_instances_at_exit() -> None:
+    for instance in list(_live_instances):
+        instance._close_at_exit()
+
+
+atexit.register(_close_instances_at_exit)
+
 # 流式保存工具
 try:
     from productAdapter.utils.dify_data_saver import (
         start_dify_stream_saver,
+        is_stream_save_enabled_by_env,
         DifyStreamingFileWriter,
     )
 except Exception as _e:  # 兜底，避免导入失败导致运行中断
     start_dify_stream_saver = None  # type: ignore
+    is_stream_save_enabled_by_env = None  # type: ignore
     DifyStreamingFileWriter = None  # type: ignore
 
+# 流式输出块模板：usage 全为0，终止块各处完全相同，共享同一实例即可
+_ZERO_USAGE = {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0}
+_FINAL_CHUNK: GenericStreamingChunk = {
+    "finish_reason": "stop",
+    "index": 0,
+    "is_finished": True,
+    "text": "",
+    "tool_use": None,
+    "usage": _ZERO_USAGE,
+}
+_TEXT_CHUNK_TEMPLATE: GenericStreamingChunk = {
+    "finish_reason": None,
+    "index": 0,
+    "is_finished": False,
+    "text": "",
+    "tool_use": None,
+    "usage": _ZERO_USAGE,
+}
+
+
+def _make_text_chunk(text: str) -> GenericStreamingChunk:
+    """基于模板构造文本块（浅拷贝后只替换text）。"""
+    chunk = _TEXT_CHUNK_TEMPLATE.copy()
+    chunk["text"] = text
+    return chunk
+
+
+def _make_stop_chunk(text: str = "") -> GenericStreamingChunk:
+    """构造携带文本（如错误信息）的终止块；无文本时直接复用共享终止块。"""
+    if not text:
+        return _FINAL_CHUNK
+    chunk = _FINAL_CHUNK.copy()
+    chunk["text"] = text
+    return chunk
+
+
+# 完成事件判定：SSE事件名，或payload中的 (字段, 值) 标记
+_FINISH_EVENT_TYPES = frozenset({"workflow_finished"})
+_FINISH_PAYLOAD_MARKERS = (("event", "workflow_finished"), ("type", "complete"))
+
+# Dify嵌套格式 {"type": ..., "chunk": ...} 必须同时具备的键（一次键视图超集判断）
+_DIFY_ENVELOPE_KEYS = frozenset({"type", "chunk"})
+
+# 微批处理按max_tokens分档（<=128、<=512、>512），预计耗时相近的请求才合并到同一批
+_BATCH_BIN_BOUNDS = (128, 512)
+
+# 紧凑格式且文本不含转义的 text_chunk 负载，命中时无需完整JSON解析
+_TEXT_CHUNK_RE = re.compile(
+    rb'\{\s*"event"\s*:\s*"text_chunk"\s*,\s*"data"\s*:\s*\{\s*"text"\s*:\s*"([^"\\]*)"\s*\}\s*\}\s*'
+)
+
+# data负载超过该字节数时改在工作线程中解析
+_JSON_OFFLOAD_THRESHOLD = 32 * 1024
+
+# 流式保存时每累计多少个SSE块写入一次
+_SAVE_FLUSH_EVERY = 32
+
+# SSE 字段前缀（按定长切片比较，避免 startswith + len() 的重复开销）
+_EVENT_PREFIX = b"event:"
+_DATA_PREFIX = b"data:"
+_COMMENT_PREFIX = b":"
+# 可能开始一个JSON值的首字节（对象、数组、字符串、数字、true/false/null）
+_JSON_START_BYTES = b'{["-0123456789tfn'
+
+
+def _is_wrapped(text: str, open_c: str, close_c: str) -> bool:
+    """判断文本去除首尾空白后是否以 open_c 开头、close_c 结尾（从两端扫描，不创建strip副本）。"""
+    start, end = 0, len(text) - 1
+    while start <= end and text[start].isspace():
+        start += 1
+    while end > start and text[end].isspace():
+        end -= 1
+    return start <= end and text[start] == open_c and text[end] == close_c
+
+
+def _parse_sse_block(block: bytes) -> tuple[Optional[str], bytes]:
+    """解析单个SSE事件块（字节），返回 (event_type, 拼接后的data字节)，data保持未解码以便直接交给JSON解析。"""
+    # 最常见的单行 data: 事件直接切片返回
+    if block[:5] == _DATA_PREFIX and b"\n" not in block:
+        return None, block[5:].lstrip()
+    event_type: Optional[str] = None
+    data_lines: list[bytes] = []
+    # 用 find 逐行定位（C层memchr扫描），不为 splitlines 分配整个行列表
+    start, size = 0, len(block)
+    while start < size:
+        end = block.find(b"\n", start)
+        if end == -1:
+            end = size
+        raw = block[start:end]
+        start = end + 1
+        if raw[-1:] == b"\r":
+            raw = raw[:-1]
+        head = raw[:6]
+        if head[:1] == _COMMENT_PREFIX:
+            continue
+        if head == _EVENT_PREFIX:
+            event_type = raw[6:].strip().decode("utf-8", errors="ignore") or None
+        elif head[:5] == _DATA_PREFIX:
+            data_lines.append(raw[5:].lstrip())
+    return event_type, b"\n".join(data_lines)
+
+
+async def _aiter_sse_blocks(content) -> AsyncIterator[bytes]:
+    """按空行切分SSE字节流，逐个产出去除首尾换行的非空事件块（含连接结束时遗留的尾块）。"""
+    # 以字节块队列暂存未完成的事件，只有出现事件分隔符时才合并，避免 buffer += chunk 的反复拷贝
+    pending: deque[bytes] = deque()
+    pending_bytes = 0
+    # 按网络实际到达的帧读取，避免固定 1KB 窗口带来的逐块调度开销
+    async for chunk, _ in content.iter_chunks():
+        if not chunk:
+            continue
+
+        # 本块内（含与上一块交界处）没有事件分隔符时仅入队
+        if b"\n\n" not in chunk and not (
+            pending_bytes and chunk[:1] == b"\n" and pending[-1][-1:] == b"\n"
+        ):
+            pending.append(chunk)
+            pending_bytes += len(chunk)
+            continue
+
+        pending.append(chunk)
+        buf = b"".join(pending)
+        pending.clear()
+
+        # 用 find + 切片逐个取出完整事件块，不再为 split 分配整个列表
+        start = 0
+        idx = buf.find(b"\n\n")
+        while idx != -1:
+            block = buf[start:idx].strip(b"\r\n")
+            if block:
+                yield block
+            start = idx + 2
+            idx = buf.find(b"\n\n", start)
+
+        rest = buf[start:]
+        pending_bytes = len(rest)
+        if rest:
+            pending.append(rest)
+
+    tail = b"".join(pending).strip(b"\r\n")
+    if tail:
+        yield tail
+
+
+def _loads_or_text(data: bytes) -> Any:
+    """按JSON解析data负载，非JSON时返回解码后的原始文本。
+
+    首字节不可能开始一个JSON值时直接按文本处理，纯文本负载不再为每块构造并抛出解析异常。
+    """
+    if data[:1] not in _JSON_START_BYTES:
+        return data.decode("utf-8", errors="ignore")
+    try:
+        return _json_loads(data)
+    except ValueError:
+        return data.decode("utf-8", errors="ignore")
+
+
+# --- _extract_text_from_sse_data 的分发表 ---
+def _sse_text_chunk(sse_data: dict) -> str:
+    # text_chunk事件：取 data.text
+    data = sse_data.get("data")
+    return (data.get("text", "") or "") if isinstance(data, dict) else ""
+
+
+def _sse_workflow_finished(sse_data: dict) -> str:
+    # 工作流完成，返回特殊标记
+    return "__WORKFLOW_FINISHED__"
+
+
+def _sse_chunk(sse_data: dict) -> str:
+    # Dify的chunk事件，直接返回chunk内容
+    return sse_data.get("chunk", "") or ""
+
+
+def _sse_status(sse_data: dict) -> str:
+    # Dify的status事件，记录但不返回内容
+    logger.debug("[custom_handler] 📊 状态更新: %s", sse_data.get("status", ""))
+    return ""
+
+
+def _sse_complete(sse_data: dict) -> str:
+    logger.debug("[custom_handler] 🏁 收到完成事件")
+    return "__WORKFLOW_FINISHED__"
+
+
+_SSE_EVENT_HANDLERS = {
+    "text_chunk": _sse_text_chunk,
+    "workflow_finished": _sse_workflow_finished,
+}
+_SSE_TYPE_HANDLERS = {
+    "chunk": _sse_chunk,
+    "status": _sse_status,
+    "complete": _sse_complete,
+}
+_SSE_SILENT_EVENTS = frozenset({"node_started", "node_finished", "workflow_started"})
+
+
+def _normalize_messages(messages: Any) -> list:
+    """确保messages是数组格式（list直接返回，字符串等包装为单条user消息）"""
+    if type(messages) is list:
+        return messages
+    if messages is None:
+        return []
+    return [{"role": "user", "content": messages if isinstance(messages, str) else str(messages)}]
+
+
+# 业务API未返回有效内容时使用的默认响应文本（不写入响应缓存）
+_DEFAULT_RESPONSE = "Hello from custom LLM!"
+_EMPTY_CONTENT_RESPONSE = "Hello from custom LLM! (业务API返回空内容)"
+_FALLBACK_RESPONSES = frozenset({_DEFAULT_RESPONSE, _EMPTY_CONTENT_RESPONSE})
+
+
+class CacheBackend(Protocol):
+    """
+    响应缓存后端协议（默认进程内LRU，可替换为Redis等外部实现）
+    进程内LRU收到可哈希元组键，其他后端收到sha256十六进制字符串键
+    """
+
+    def get(self, key: Hashable) -> Optional[str]: ...
+
+    def set(self, key: Hashable, value: str) -> None: ...
+
+
+class MemoryCacheBackend:
+    """
+    进程内LRU缓存
+    仅缓存确定性（temperature == 0）请求的响应文本
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, str]" = OrderedDict()
+        # 同步路径可能在多个线程中并发调用，move_to_end/popitem需加锁
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[str]:
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: str) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+
 class MyCustomLLM(CustomLLM):
     """
     自定义LLM处理器
     继承自LiteLLM的CustomLLM基类
     """
+
+    # 按response_format.type判定为JSON响应的类型集合
+    _json_types = frozenset({"json_schema", "json_object"})
     
-    def __init__(self):
+    def __init__(self, cache_backend: Optional[CacheBackend] = None):
         super().__init__()
         # 使用模拟SSE服务器进行测试
         self.api_base = "http://localhost:8002/api/process"
-        print("[custom_handler] MyCustomLLM初始化完成 - 使用模拟SSE服务器")
+        # 复用连接池，避免每次请求都重新建立TCP/TLS连接
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._headers = {"Content-Type": "application/json"}
+        self._session.headers.update(self._headers)
+        self._timeout = 30
+        # 业务请求体模板，每次请求在其副本上填充变化字段
+        self._req_template = {"response_type": "text", "stream": False}
+        # 异步会话需在事件循环内懒创建，按事件循环分别复用（后台循环与调用方循环互不干扰）
+        self._aiohttp_sessions: Dict[asyncio.AbstractEventLoop, Any] = {}
+        # 流式请求的超时对象，首次创建aiohttp会话时构造一次后复用
+        self._stream_timeout = None
+        # aiohttp连接池总上限；业务API为单一主机，不再单独限制每主机连接数
+        self._pool_limit = int(os.environ.get("CUSTOM_HANDLER_POOL_LIMIT", "100") or 100)
+        # 微批处理（默认关闭）：窗口期内到达的acompletion合并为一次 {"batch": [...]} 请求
+        self._batch_window_ms = int(os.environ.get("CUSTOM_HANDLER_BATCH_WINDOW_MS", "0") or 0)
+        self._batch_max_size = int(os.environ.get("CUSTOM_HANDLER_BATCH_MAX_SIZE", "16") or 16)
+        self._batch_supported = True
+        # 每个max_tokens档位各自的待发送队列与定时刷新任务，短请求不会被长请求拖慢
+        self._pending: Dict[int, List[tuple[Dict[str, Any], asyncio.Future]]] = {}
+        self._flush_tasks: Dict[int, asyncio.Task] = {}
+        # 进行中的批量发送任务需保留强引用，否则可能在完成前被垃圾回收
+        self._batch_tasks: Set[asyncio.Task] = set()
+        # 确定性请求的响应缓存
+        self._cache: CacheBackend = cache_backend or MemoryCacheBackend(
+            maxsize=int(os.environ.get("CUSTOM_HANDLER_CACHE_SIZE", "1024") or 1024)
+        )
+        # 进程退出时释放复用的连接池（由模块级atexit钩子统一处理）
+        _live_instances.add(self)
+        logger.info("[custom_handler] MyCustomLLM初始化完成 - 使用模拟SSE服务器")
+
+    def close(self) -> None:
+        """关闭复用的HTTP会话。"""
+        try:
+            self._session.close()
+        except Exception:
+            pass
+
+    async def aclose(self) -> None:
+        """关闭当前事件循环内复用的aiohttp会话（服务关闭时调用）。"""
+        session = self._aiohttp_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None and not session.closed:
+            await session.close()
+
+    def __del__(self):
+        self.close()
+
+    def _close_at_exit(self) -> None:
+        """进程退出时关闭同步会话，以及所属事件循环仍可用的aiohttp会话。"""
+        self.close()
+        for loop, session in list(self._aiohttp_sessions.items()):
+            if session.closed or loop.is_closed():
+                continue
+            try:
+                if loop is _bg_loop:
+                    asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout=5)
+                elif not loop.is_running():
+                    loop.run_until_complete(session.close())
+            except Exception:
+                pass
+        self._aiohttp_sessions.clear()
+
+    async def _get_aiohttp_session(self):
+        """获取当前事件循环内复用的aiohttp会话（连接池 + keep-alive）。"""
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        session = self._aiohttp_sessions.get(loop)
+        if session is None or session.closed:
+            # 顺带丢弃已关闭事件循环遗留的会话
+            for stale in [l for l in self._aiohttp_sessions if l.is_closed()]:
+                del self._aiohttp_sessions[stale]
+            # 请求头与默认30秒超时作为会话级默认值，单次请求无需再传入
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._pool_limit, limit_per_host=0, ttl_dns_cache=300, keepalive_timeout=30
+                ),
+                headers=self._headers,
+                timeout=aiohttp.ClientTimeout(total=30),
+            )
+            self._aiohttp_sessions[loop] = session
+            if self._stream_timeout is None:
+                # 流式请求不设总超时：等待连接池的时间不占用流式读取时间，改为限制建连与两次读取之间的间隔
+                self._stream_timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+        return session
+
+    async def _apost_business_request(self, business_request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """异步发送单条业务请求，成功返回响应JSON，业务API报错时返回None。"""
+        session = await self._get_aiohttp_session()
+        async with session.post(self.api_base, data=_json_dumps(business_request)) as response:
+            if response.status == 200:
+                return _json_loads(await response.read())
+            error_text = await response.text()
+            logger.warning("[custom_handler] 业务API错误: %s - %s", response.status, error_text)
+            return None
+
+    # --- 微批处理 ---
+    async def _submit_batched(self, business_request: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """将请求放入所属max_tokens档位的待发送队列，等待所在批次返回对应结果。"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        bin_index = bisect.bisect_left(_BATCH_BIN_BOUNDS, business_request["max_tokens"])
+        pending = self._pending.setdefault(bin_index, [])
+        pending.append((business_request, future))
+        if len(pending) >= self._batch_max_size:
+            self._flush_pending(bin_index)
+        elif bin_index not in self._flush_tasks:
+            self._flush_tasks[bin_index] = loop.create_task(
+                self._flush_after(bin_index, self._batch_window_ms / 1000.0)
+            )
+        return await future
+
+    async def _flush_after(self, bin_index: int, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._flush_pending(bin_index)
+
+    def _flush_pending(self, bin_index: int) -> None:
+        # 按数量提前刷新时，撤销该档位尚未触发的定时刷新
+        timer = self._flush_tasks.pop(bin_index, None)
+        if timer is not None and timer is not asyncio.current_task():
+            timer.cancel()
+        drained = self._pending.pop(bin_index, None)
+        if drained:
+            task = asyncio.get_running_loop().create_task(self._send_batch(drained))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _send_batch(self, drained: List[tuple[Dict[str, Any], asyncio.Future]]) -> None:
+        """一次POST发送整批请求，并按顺序把结果分发回各自的future。"""
+        results: Any = None
+        if len(drained) > 1 and self._batch_supported:
+            try:
+                session = await self._get_aiohttp_session()
+                async with session.post(
+                    self.api_base,
+                    data=_json_dumps({"batch": [req for req, _ in drained]}),
+                ) as response:
+                    status = response.status
+                    payload = _json_loads(await response.read()) if status == 200 else None
+                if status != 200:
+                    # 限流、5xx等非200响应只影响本批次，不据此判定业务API不支持批量
+                    logger.warning("[custom_handler] 批量请求返回状态码 %s，本批次退回逐条请求", status)
+                else:
+                    results = payload.get("batch") if isinstance(payload, dict) else payload
+                    if not isinstance(results, list) or len(results) != len(drained):
+                        # 业务API仍是单条协议，后续退回逐条请求
+                        logger.warning("[custom_handler] 业务API不支持批量请求，退回逐条请求模式")
+                        self._batch_supported = False
+                        results = None
+            except Exception as e:
+                logger.warning("[custom_handler] 批量请求失败，本批次退回逐条请求: %s", e)
+                results = None
+
+        if results is None:
+            results = await asyncio.gather(
+                *(self._apost_business_request(req) for req, _ in drained),
+                return_exceptions=True,
+            )
+
+        for (_, future), result in zip(drained, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
 
     # --- 流式保存封装 ---
     def init_start_dify_stream_saver(
@@ -64,8 +542,8 @@ class MyCustomLLM(CustomLLM):
         if start_dify_stream_saver is None:
             return None, False, None
         try:
-            project_root = os.path.abspath(os.path.dirname(__file__))
-            rid = response_id or f"custom-{uuid.uuid4().hex[:10]}"
+            project_root = _project_root
+            rid = response_id or f"custom-{os.urandom(5).hex()}"
             stream_saver, enabled = start_dify_stream_saver(
                 response_id=rid,
                 query=query_messages,
@@ -74,24 +552,24 @@ class MyCustomLLM(CustomLLM):
                 enable_stream_save=enable_stream_save,
             )
             logger.info(
-                f"[custom_handler] init_start_dify_stream_saver: enabled={enabled}, response_id={rid}, saver={stream_saver}"
+                "[custom_handler] init_start_dify_stream_saver: enabled=%s, response_id=%s, saver=%s", enabled, rid, stream_saver
             )
             return stream_saver, enabled, rid
         except Exception as se:
-            logger.warning(f"[custom_handler] 启动流式保存器失败: {se}")
+            logger.warning("[custom_handler] 启动流式保存器失败: %s", se)
             return None, False, None
 
-    def save_stream_chunk(
+    def save_stream_chunks(
         self,
         stream_saver: Optional[DifyStreamingFileWriter],
         enabled: bool,
-        data: Any,
+        lines: List[str],
     ) -> None:
-        """边流边写入一段数据。"""
-        if not enabled or stream_saver is None:
+        """批量写入多段数据（每段仍记录为独立数据块）。"""
+        if not enabled or stream_saver is None or not lines:
             return
         try:
-            stream_saver.write(data if isinstance(data, str) else str(data))
+            stream_saver.write_many(lines)
         except Exception:
             pass
 
@@ -129,129 +607,96 @@ class MyCustomLLM(CustomLLM):
         if stats is None:
             stats = {"chunk_count": 0, "event_count": 0}
 
-        buffer = ""
-        previous_text_fragment: Optional[str] = None
+        # 记录上一次输出片段去除首尾空白后的结果，每个片段只 strip 一次
+        previous_stripped: Optional[str] = None
         seen_structured_chunk: bool = False
         have_seen_non_snapshot_chunk: bool = False
         full_snapshot_emitted: bool = False
 
-        def parse_sse_block(block: str) -> tuple[Optional[str], str]:
-            event_type: Optional[str] = None
-            data_lines: list[str] = []
-            for raw in block.splitlines():
-                if raw.startswith(":"):
-                    continue
-                if raw.startswith("event:"):
-                    event_type = raw[len("event:"):].strip() or None
-                elif raw.startswith("data:"):
-                    data_lines.append(raw[len("data:"):].lstrip())
-            return event_type, "\n".join(data_lines)
-
-        async for chunk in response.content.iter_chunked(1024):
-            if not chunk:
-                continue
-            try:
-                chunk_str = chunk.decode("utf-8", errors="ignore")
-            except Exception:
-                continue
-
-            buffer += chunk_str
-
-            # 按双换行拆分完整事件块
-            while "\n\n" in buffer:
-                block, buffer = buffer.split("\n\n", 1)
-                block = block.strip("\r\n")
-                if not block:
+        # 计数使用局部变量，退出时（含提前结束）一次性写回 stats
+        event_count = 0
+        chunk_count = 0
+        # 原始块先攒在本地，每 _SAVE_FLUSH_EVERY 块合并写入一次保存器，退出时写入剩余部分
+        save_batch: list[str] = []
+        try:
+            # 连接结束时未以空行结束的最后一块也由 _aiter_sse_blocks 一并产出，走同一套处理逻辑
+            async for block in _aiter_sse_blocks(response.content):
+                # 单行注释块（": keepalive" 等保活）不是事件：不解析、不保存、不计数
+                if block[:1] == _COMMENT_PREFIX and b"\n" not in block:
                     continue
+                event_type, data_payload = _parse_sse_block(block)
 
-                event_type, data_payload = parse_sse_block(block)
-
-                # 保存原始块（带 data 拼接后的内容）
-                self.save_stream_chunk(stream_saver, enable_stream_save, f"[block] event={event_type or 'message'}\n{block}\n\n")
+                # 保存原始块（带 data 拼接后的内容）；仅在启用保存时才解码
+                if enable_stream_save:
+                    save_batch.append(f"[block] event={event_type or 'message'}\n{block.decode('utf-8', errors='ignore')}\n\n")
+                    if len(save_batch) >= _SAVE_FLUSH_EVERY:
+                        self.save_stream_chunks(stream_saver, enable_stream_save, save_batch)
+                        save_batch.clear()
 
                 # 统计事件数量（包含 ping / message / response 等）
-                stats["event_count"] = stats.get("event_count", 0) + 1
+                event_count += 1
 
                 # 跳过 ping 或空数据
                 if event_type == "ping" or not data_payload.strip():
                     continue
 
-                if data_payload.strip() == "[DONE]":
-                    final_chunk: GenericStreamingChunk = {
-                        "finish_reason": "stop",
-                        "index": 0,
-                        "is_finished": True,
-                        "text": "",
-                        "tool_use": None,
-                        "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                    }
-                    yield final_chunk
+                if data_payload.strip() == b"[DONE]":
+                    yield _FINAL_CHUNK
                     return
 
-                # 解析 JSON，兼容多种Dify格式，尽可能提取增量文本
-                try:
-                    payload = json.loads(data_payload)
-                except Exception:
-                    payload = data_payload  # 保留原始文本
+                # 最常见的 text_chunk 事件（文本不含转义字符）直接用正则取出文本，不构造字典
+                fast_match = None
+                if not seen_structured_chunk and event_type not in _FINISH_EVENT_TYPES:
+                    fast_match = _TEXT_CHUNK_RE.fullmatch(data_payload)
+                if fast_match is not None:
+                    extracted_text = fast_match.group(1).decode("utf-8", errors="ignore")
+                else:
+                    # 解析 JSON，兼容多种Dify格式，尽可能提取增量文本
+                    # 超大负载（如节点的完整输出）放到工作线程解析，解析期间事件循环仍可调度其他并发流
+                    if len(data_payload) < _JSON_OFFLOAD_THRESHOLD:
+                        payload = _loads_or_text(data_payload)
+                    else:
+                        payload = await asyncio.to_thread(_loads_or_text, data_payload)
 
-                # 无论是否处于 structured chunk 流，优先检测完成事件，避免卡死
-                try:
-                    if (event_type == "workflow_finished") or (
-                        isinstance(payload, dict) and (
-                            payload.get("event") == "workflow_finished" or payload.get("type") == "complete"
-                        )
-                    ):
-                        final_chunk: GenericStreamingChunk = {
-                            "finish_reason": "stop",
-                            "index": 0,
-                            "is_finished": True,
-                            "text": "",
-                            "tool_use": None,
-                            "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                        }
-                        yield final_chunk
+                    # 无论是否处于 structured chunk 流，优先检测完成事件，避免卡死
+                    finished = event_type in _FINISH_EVENT_TYPES
+                    if not finished and isinstance(payload, dict):
+                        for marker_key, marker_value in _FINISH_PAYLOAD_MARKERS:
+                            if payload.get(marker_key) == marker_value:
+                                finished = True
+                                break
+                    if finished:
+                        yield _FINAL_CHUNK
                         return
-                except Exception:
-                    pass
 
-                extracted_text: str = ""
-                try:
-                    if isinstance(payload, dict):
-                        # 优先直接透传 chunk 的原始字符串，避免内层JSON解析失败
-                        if "type" in payload and "chunk" in payload:
-                            inner_chunk = payload.get("chunk", "")
-                            if isinstance(inner_chunk, str) and inner_chunk:
-                                extracted_text = inner_chunk
-                                seen_structured_chunk = True
-                        # 当检测到 structured chunk 流时，避免同时再输出 text_chunk，防止重复累积导致上游解析出错
-                        if not extracted_text and not seen_structured_chunk:
-                            extracted_text = self._extract_text_from_sse_data(payload)
-                        if not extracted_text:
-                            extracted_text = (
-                                payload.get("data", {})
-                                .get("outputs", {})
-                                .get("text", "")
-                            )
-                    elif isinstance(payload, str):
-                        extracted_text = payload
-                except Exception:
                     extracted_text = ""
+                    try:
+                        if isinstance(payload, dict):
+                            # 优先直接透传 chunk 的原始字符串，避免内层JSON解析失败
+                            if payload.keys() >= _DIFY_ENVELOPE_KEYS:
+                                inner_chunk = payload["chunk"]
+                                if isinstance(inner_chunk, str) and inner_chunk:
+                                    extracted_text = inner_chunk
+                                    seen_structured_chunk = True
+                            # 当检测到 structured chunk 流时，避免同时再输出 text_chunk，防止重复累积导致上游解析出错
+                            if not extracted_text and not seen_structured_chunk:
+                                extracted_text = self._extract_text_from_sse_data(payload)
+                            if not extracted_text:
+                                # 逐层显式判断 data.outputs.text，避免每层缺失时创建临时空字典
+                                data = payload.get("data")
+                                outputs = data.get("outputs") if isinstance(data, dict) else None
+                                extracted_text = outputs.get("text", "") if isinstance(outputs, dict) else ""
+                        elif isinstance(payload, str):
+                            extracted_text = payload
+                    except Exception:
+                        extracted_text = ""
 
                 if extracted_text == "__WORKFLOW_FINISHED__":
-                    final_chunk: GenericStreamingChunk = {
-                        "finish_reason": "stop",
-                        "index": 0,
-                        "is_finished": True,
-                        "text": "",
-                        "tool_use": None,
-                        "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                    }
-                    yield final_chunk
+                    yield _FINAL_CHUNK
                     return
 
                 if isinstance(extracted_text, str) and extracted_text:
-                    stripped_text = extracted_text.strip()
-                    is_full_json_snapshot = stripped_text.startswith('{') and stripped_text.endswith('}')
+                    is_full_json_snapshot = _is_wrapped(extracted_text, '{', '}')
 
                     # 若已输出过增量片段，则丢弃后续完整快照，避免上游累积两份JSON
                     if is_full_json_snapshot and have_seen_non_snapshot_chunk:
@@ -259,133 +704,41 @@ class MyCustomLLM(CustomLLM):
                     # 完整快照只允许输出一次
                     if is_full_json_snapshot and full_snapshot_emitted:
                         continue
-                    # 去重（忽略纯空白差异）
-                    if previous_text_fragment is not None and stripped_text == previous_text_fragment.strip():
+                    # 去重（忽略纯空白差异）；被丢弃的快照无需 strip
+                    stripped_text = extracted_text.strip()
+                    if stripped_text == previous_stripped:
                         continue
 
-                    previous_text_fragment = extracted_text
+                    previous_stripped = stripped_text
                     if is_full_json_snapshot:
                         full_snapshot_emitted = True
                     else:
                         have_seen_non_snapshot_chunk = True
 
-                    stats["chunk_count"] = stats.get("chunk_count", 0) + 1
-                    generic_streaming_chunk: GenericStreamingChunk = {
-                        "finish_reason": None,
-                        "index": 0,
-                        "is_finished": False,
-                        "text": extracted_text,
-                        "tool_use": None,
-                        "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                    }
-                    yield generic_streaming_chunk
-
-        # 处理连接结束后 buffer 中遗留的最后一块（若没有以空行结束）
-        tail = buffer.strip("\r\n")
-        if tail:
-            event_type, data_payload = parse_sse_block(tail)
-            self.save_stream_chunk(stream_saver, enable_stream_save, f"[tail-block] event={event_type or 'message'}\n{tail}\n")
-            stats["event_count"] = stats.get("event_count", 0) + 1
-            if data_payload.strip() and event_type != "ping":
-                if data_payload.strip() == "[DONE]":
-                    final_chunk: GenericStreamingChunk = {
-                        "finish_reason": "stop",
-                        "index": 0,
-                        "is_finished": True,
-                        "text": "",
-                        "tool_use": None,
-                        "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                    }
-                    yield final_chunk
-                    return
-                try:
-                    payload = json.loads(data_payload)
-                except Exception:
-                    payload = data_payload
-                # 尾块也要优先检测完成事件，避免卡死
-                try:
-                    if (event_type == "workflow_finished") or (
-                        isinstance(payload, dict) and (
-                            payload.get("event") == "workflow_finished" or payload.get("type") == "complete"
-                        )
-                    ):
-                        final_chunk: GenericStreamingChunk = {
-                            "finish_reason": "stop",
-                            "index": 0,
-                            "is_finished": True,
-                            "text": "",
-                            "tool_use": None,
-                            "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                        }
-                        yield final_chunk
-                        return
-                except Exception:
-                    pass
-                extracted_text = ""
-                try:
-                    if isinstance(payload, dict):
-                        if "type" in payload and "chunk" in payload:
-                            inner_chunk = payload.get("chunk", "")
-                            if isinstance(inner_chunk, str) and inner_chunk:
-                                extracted_text = inner_chunk
-                                seen_structured_chunk = True
-                        if not extracted_text and not seen_structured_chunk:
-                            extracted_text = self._extract_text_from_sse_data(payload)
-                        if not extracted_text:
-                            extracted_text = (
-                                payload.get("data", {})
-                                .get("outputs", {})
-                                .get("text", "")
-                            )
-                    elif isinstance(payload, str):
-                        extracted_text = payload
-                except Exception:
-                    extracted_text = ""
+                    chunk_count += 1
+                    yield _make_text_chunk(extracted_text)
 
-                if isinstance(extracted_text, str) and extracted_text:
-                    stripped_text = extracted_text.strip()
-                    is_full_json_snapshot = stripped_text.startswith('{') and stripped_text.endswith('}')
-                    if is_full_json_snapshot and have_seen_non_snapshot_chunk:
-                        pass
-                    elif is_full_json_snapshot and full_snapshot_emitted:
-                        pass
-                    elif previous_text_fragment is not None and stripped_text == previous_text_fragment.strip():
-                        pass
-                    else:
-                        previous_text_fragment = extracted_text
-                        if is_full_json_snapshot:
-                            full_snapshot_emitted = True
-                        else:
-                            have_seen_non_snapshot_chunk = True
-                        stats["chunk_count"] = stats.get("chunk_count", 0) + 1
-                        generic_streaming_chunk: GenericStreamingChunk = {
-                            "finish_reason": None,
-                            "index": 0,
-                            "is_finished": False,
-                            "text": extracted_text,
-                            "tool_use": None,
-                            "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                        }
-                        yield generic_streaming_chunk
-
-        # 结束兜底
-        final_chunk: GenericStreamingChunk = {
-            "finish_reason": "stop",
-            "index": 0,
-            "is_finished": True,
-            "text": "",
-            "tool_use": None,
-            "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-        }
-        yield final_chunk
-    
-    def _extract_response_format(self, kwargs: dict, key: str = "response_format") -> tuple[Optional[Dict[str, Any]], str]:
+            # 结束兜底
+            yield _FINAL_CHUNK
+        finally:
+            if save_batch:
+                self.save_stream_chunks(stream_saver, enable_stream_save, save_batch)
+            stats["event_count"] = stats.get("event_count", 0) + event_count
+            stats["chunk_count"] = stats.get("chunk_count", 0) + chunk_count
+
+    def _extract_response_format(
+        self,
+        kwargs: dict,
+        key: str = "response_format",
+        optional_params: Optional[dict] = None,
+    ) -> tuple[Optional[Dict[str, Any]], str]:
         """
         从kwargs中提取指定参数并确定响应类型
         
         Args:
             kwargs: 包含optional_params和指定参数的参数字典
             key: 要提取的参数名称，默认为 "response_format"
+            optional_params: 调用方已取出的optional_params，省略时从kwargs中读取
             
         Returns:
             tuple: (extracted_value, response_type)
@@ -399,665 +752,339 @@ class MyCustomLLM(CustomLLM):
             # 提取temperature参数
             temperature, _ = self._extract_response_format(kwargs, "temperature")
         """
-        if not isinstance(kwargs, dict):
-            print(f"[custom_handler] ⚠️ kwargs不是字典类型: {type(kwargs)}")
-            return None, "text"
-        
-        # 安全地检查optional_params中的指定参数
-        optional_params = kwargs.get('optional_params', {})
-        if optional_params and not isinstance(optional_params, dict):
-            print(f"[custom_handler] ⚠️ optional_params不是字典类型: {type(optional_params)}")
-            optional_params = {}
-        
-        print(f"[custom_handler] optional_params keys: {list(optional_params.keys()) if optional_params else 'None'}")
-        
+        if optional_params is None:
+            optional_params = kwargs.get("optional_params")
         # 优先从optional_params中获取指定参数，如果没有再从kwargs中获取
-        extracted_value = None
-        if optional_params and key in optional_params:
-            extracted_value = optional_params[key]
-            print(f"[custom_handler] ✅ 从optional_params检测到{key}: {extracted_value.get('type', 'unknown') if isinstance(extracted_value, dict) else extracted_value}")
-            if extracted_value and isinstance(extracted_value, dict):
-                print(f"[custom_handler] optional_params.{key}详情: {json.dumps(extracted_value, ensure_ascii=False, indent=2)}")
-        elif kwargs.get(key) is not None:
+        extracted_value = optional_params.get(key) if isinstance(optional_params, dict) else None
+        if extracted_value is None:
             extracted_value = kwargs.get(key)
-            print(f"[custom_handler] ✅ 从kwargs检测到{key}: {extracted_value.get('type', 'unknown') if isinstance(extracted_value, dict) else extracted_value}")
-            if isinstance(extracted_value, dict):
-                print(f"[custom_handler] {key}详情: {json.dumps(extracted_value, ensure_ascii=False, indent=2)}")
-        else:
-            print(f"[custom_handler] ⚠️ 未检测到{key}参数（kwargs.{key}={kwargs.get(key)}, optional_params.{key}={optional_params.get(key) if optional_params else 'N/A'}）")
+            if extracted_value is None:
+                return None, "text"
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[custom_handler] 检测到%s: %s", key, extracted_value)
         
         # 确定响应类型（仅对response_format参数）
-        response_type = "text"
-        if key == "response_format" and extracted_value:
-            if isinstance(extracted_value, dict):
-                if extracted_value.get("type") == "json_schema":
-                    response_type = "json"
-                    print(f"[custom_handler] 设置响应类型为JSON（structured output）")
-                elif extracted_value.get("type") == "json_object":
-                    response_type = "json"
-                    print(f"[custom_handler] 设置响应类型为JSON object")
-        
-        return extracted_value, response_type
+        if key == "response_format" and isinstance(extracted_value, dict):
+            return extracted_value, ("json" if extracted_value.get("type") in self._json_types else "text")
+        return extracted_value, "text"
     
+    @staticmethod
+    def _get_param(kwargs: dict, key: str, default: Any = None, optional_params: Optional[dict] = None) -> Any:
+        """优先从optional_params读取参数（LiteLLM的传参位置），其次从kwargs读取。"""
+        if optional_params is None:
+            optional_params = kwargs.get("optional_params")
+        if isinstance(optional_params, dict) and optional_params.get(key) is not None:
+            return optional_params[key]
+        value = kwargs.get(key)
+        return default if value is None else value
+
+    def _numeric_params(self, kwargs: dict, optional_params: Optional[dict] = None) -> tuple[float, int]:
+        """读取并规范化temperature/max_tokens为原生数值（兼容字符串、Decimal等传参）。"""
+        if optional_params is None:
+            optional_params = kwargs.get("optional_params")
+        try:
+            temperature = float(self._get_param(kwargs, "temperature", 0.7, optional_params))
+        except (TypeError, ValueError):
+            temperature = 0.7
+        try:
+            max_tokens = int(self._get_param(kwargs, "max_tokens", 100, optional_params))
+        except (TypeError, ValueError):
+            max_tokens = 100
+        return temperature, max_tokens
+
+    def _build_business_request(self, kwargs: dict, messages: list, stream: Any) -> Dict[str, Any]:
+        """根据kwargs与messages构建业务API请求体（同步/异步共用）。"""
+        model = kwargs.get("model", "business-api")
+        # optional_params只取一次，供各参数读取共用
+        optional_params = kwargs.get("optional_params")
+        # 提取response_format并确定响应类型
+        response_format, response_type = self._extract_response_format(kwargs, "response_format", optional_params)
+        temperature, max_tokens = self._numeric_params(kwargs, optional_params)
+        business_request = self._req_template.copy()
+        business_request.update(
+            # 全量转发完整的messages数组；response_format作为附加消息放入新列表，不修改调用方的messages
+            query=[*messages, {"role": "response_format", "content": response_format}],
+            model_info={"name": model},
+            response_type=response_type,
+            response_format=response_format,
+            stream=stream,
+            temperature=temperature,
+            max_tokens=max_tokens,
+        )
+        return business_request
+
+    def _cache_key(self, business_request: Dict[str, Any], messages: list) -> Optional[Hashable]:
+        """
+        根据即将转发的业务请求体构建响应缓存键；非确定性请求（temperature > 0 或流式）返回None。
+
+        键覆盖所有转发给业务API的参数（model、messages的全部字段、temperature、max_tokens、response_format）。
+        进程内LRU直接使用可哈希元组作为键，避免每次请求都对整段对话做JSON序列化 + sha256；
+        外部缓存后端或消息字段不可哈希（如content列表、tool_calls）时使用sha256摘要。
+        """
+        if business_request.get("stream") is True:
+            return None
+        temperature = business_request.get("temperature")
+        try:
+            if temperature is None or float(temperature) != 0:
+                return None
+        except (TypeError, ValueError):
+            return None
+        if isinstance(self._cache, MemoryCacheBackend):
+            try:
+                response_format = business_request["response_format"]
+                key = (
+                    business_request["model_info"]["name"],
+                    temperature,
+                    business_request["max_tokens"],
+                    business_request["response_type"],
+                    None if response_format is None else json.dumps(response_format, sort_keys=True, default=str),
+                    tuple(tuple(sorted(m.items())) for m in messages),
+                )
+                hash(key)
+                return key
+            except (TypeError, AttributeError):
+                pass
+        raw = json.dumps(business_request, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _parse_business_response(self, business_response: Dict[str, Any]) -> str:
+        """从业务API响应中提取返回给客户端的文本内容（同步/异步共用）。"""
+        # 修复：正确提取content字段
+        content = business_response.get("content", _DEFAULT_RESPONSE)
+        if isinstance(content, dict) and "message" in content:
+            # 提取message字段中的JSON字符串
+            mock_response = content["message"]
+            logger.debug("[custom_handler] 提取到JSON内容: %.100s...", mock_response)
+        else:
+            # 如果不是预期格式，直接使用content
+            mock_response = content if isinstance(content, str) else str(content)
+            logger.debug("[custom_handler] 使用原始内容: %s", mock_response)
+
+        # 确保mock_response不为空
+        if not mock_response or mock_response.strip() == "":
+            mock_response = _EMPTY_CONTENT_RESPONSE
+            logger.debug("[custom_handler] 业务API返回空内容，使用默认响应: %s", mock_response)
+        return mock_response
+
+    def _build_model_response(self, model: str, content: str) -> ModelResponse:
+        """直接构造ModelResponse，无需再经过litellm.completion的mock_response流程。"""
+        return ModelResponse(
+            id=f"chatcmpl-{uuid.uuid4().hex}",
+            created=int(time.time()),
+            model=model,
+            object="chat.completion",
+            choices=[
+                Choices(
+                    index=0,
+                    message=Message(role="assistant", content=content),
+                    finish_reason="stop",
+                )
+            ],
+            usage=Usage(prompt_tokens=0, completion_tokens=0, total_tokens=0),
+        )
+
     def completion(self, *args, **kwargs) -> litellm.ModelResponse:
         """
         同步完成方法
         根据官方文档实现
         """
+        # 从kwargs中提取参数
+        model = kwargs.get("model", "business-api")
+        messages = _normalize_messages(kwargs.get("messages", []))
         try:
-            # 从kwargs中提取参数
-            model = kwargs.get("model", "business-api")
-            messages = kwargs.get("messages", [])
-            max_tokens = kwargs.get("max_tokens", 100)
-            temperature = kwargs.get("temperature", 0.7)
-            print(f'[custom_handler] messages: {messages}')
-            # 确保messages是数组格式
-            if not isinstance(messages, list):
-                print(f"[custom_handler] 警告：messages不是数组格式，类型为{type(messages)}，转换为数组")
-                if isinstance(messages, str):
-                    messages = [{"role": "user", "content": messages}]
-                elif messages is None:
-                    messages = []
-                else:
-                    messages = [{"role": "user", "content": str(messages)}]
+            debug_enabled = logger.isEnabledFor(logging.DEBUG)
+            logger.debug("[custom_handler] messages: %s", messages)
+            if debug_enabled:
+                logger.debug("[custom_handler] 处理completion请求: model=%s, messages=%d条消息", model, len(messages))
+                logger.debug("[custom_handler] 完整kwargs keys: %s", list(kwargs.keys()))
             
-            print(f"[custom_handler] 处理completion请求: model={model}, messages={len(messages)}条消息")
-            print(f"[custom_handler] 完整kwargs keys: {list(kwargs.keys())}")
-            
-            # 提取response_format并确定响应类型
-            response_format, response_type = self._extract_response_format(kwargs, "response_format")
-            messages.append({"role": "response_format", "content": response_format})
-            stream = self._extract_response_format(kwargs, "stream")
+            # 非流式路径：业务API以JSON返回（流式请求由LiteLLM路由到streaming/astreaming）
+            stream = False
             # 构建业务API请求
-            business_request = {
-                "query": messages,  # 全量转发完整的messages数组
-                "model_info": {
-                    "name": model
-                },
-                "response_type": response_type,
-                "stream": stream,
-                "temperature": temperature,
-                "max_tokens": max_tokens
-            }
+            business_request = self._build_business_request(kwargs, messages, stream)
+            cache_key = self._cache_key(business_request, messages)
+            cached = self._cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                logger.info("[custom_handler] completion命中响应缓存: model=%s", model)
+                return self._build_model_response(model, cached)
             
-            print(f"[custom_handler] 发送到业务API的请求: {json.dumps(business_request, ensure_ascii=False, indent=2)}")
+            logger.debug("[custom_handler] 发送到业务API的请求: %s", business_request)
             # 发送请求到业务API
-            response = requests.post(
+            response = self._session.post(
                 self.api_base,
-                json=business_request,
-                headers={"Content-Type": "application/json"},
-                timeout=30
+                data=_json_dumps(business_request),
+                timeout=self._timeout
             )
             
             if response.status_code == 200:
-                business_response = response.json()
-                print(f"[custom_handler] 业务API响应: {json.dumps(business_response, ensure_ascii=False, indent=2)}")
+                business_response = _json_loads(response.content)
+                logger.debug("[custom_handler] 业务API响应: %s", business_response)
+                mock_response = self._parse_business_response(business_response)
+                # 业务API未返回有效内容时的默认文本不写入缓存
+                if cache_key is not None and mock_response not in _FALLBACK_RESPONSES:
+                    self._cache.set(cache_key, mock_response)
+                logger.info("[custom_handler] completion请求处理完成: model=%s, messages=%d条", model, len(messages))
                 
-                # 修复：正确提取content字段
-                content = business_response.get("content", "Hello from custom LLM!")
-                if isinstance(content, dict) and "message" in content:
-                    # 提取message字段中的JSON字符串
-                    mock_response = content["message"]
-                    print(f"[custom_handler] 提取到JSON内容: {mock_response[:100]}...")
-                else:
-                    # 如果不是预期格式，直接使用content
-                    mock_response = content if isinstance(content, str) else str(content)
-                    print(f"[custom_handler] 使用原始内容: {mock_response}")
-                
-                # 确保mock_response不为空
-                if not mock_response or mock_response.strip() == "":
-                    mock_response = "Hello from custom LLM! (业务API返回空内容)"
-                    print(f"[custom_handler] 业务API返回空内容，使用默认响应: {mock_response}")
-                
-                return litellm.completion(
-                    model="gpt-3.5-turbo",  # 使用一个已知的模型格式
-                    messages=messages,  # 使用完整的messages数组
-                    mock_response=mock_response,
-                    api_key="dummy-key",  # 添加api_key参数
-                )
+                return self._build_model_response(model, mock_response)
             else:
-                print(f"[custom_handler] 业务API错误: {response.status_code} - {response.text}")
-                # 返回错误响应
-                return litellm.completion(
-                    model="gpt-3.5-turbo",
-                    messages=messages,  # 使用完整的messages数组
-                    mock_response="抱歉，服务暂时不可用。",
-                    api_key="dummy-key",  # 添加api_key参数
+                # 业务API固定返回UTF-8：直接解码字节，跳过requests的字符集探测
+                logger.warning(
+                    "[custom_handler] 业务API错误: %s - %s",
+                    response.status_code, response.content.decode("utf-8", errors="replace"),
                 )
+                # 返回错误响应
+                return self._build_model_response(model, "抱歉，服务暂时不可用。")
                 
         except Exception as e:
-            print(f"[custom_handler] 处理completion请求时出错: {str(e)}")
-            # 确保messages是数组格式
-            if 'messages' in locals():
-                if not isinstance(messages, list):
-                    if isinstance(messages, str):
-                        messages = [{"role": "user", "content": messages}]
-                    elif messages is None:
-                        messages = []
-                    else:
-                        messages = [{"role": "user", "content": str(messages)}]
-            else:
-                messages = []
-            
+            logger.error("[custom_handler] 处理completion请求时出错: %s", e)
             # 返回错误响应
-            return litellm.completion(
-                model="gpt-3.5-turbo",
-                messages=messages,  # 使用完整的messages数组
-                mock_response="抱歉，处理请求时出现错误。",
-                api_key="dummy-key",  # 添加api_key参数
-            )
+            return self._build_model_response(model, "抱歉，处理请求时出现错误。")
 
     async def acompletion(self, *args, **kwargs) -> litellm.ModelResponse:
         """
         异步完成方法
         根据官方文档实现
         """
+        # 从kwargs中提取参数
+        model = kwargs.get("model", "business-api")
+        messages = _normalize_messages(kwargs.get("messages", []))
         try:
-            # 从kwargs中提取参数
-            model = kwargs.get("model", "business-api")
-            messages = kwargs.get("messages", [])
-            max_tokens = kwargs.get("max_tokens", 100)
-            temperature = kwargs.get("temperature", 0.7)
-            stream = kwargs.get("stream", False)
+            # 非流式路径：业务API以JSON返回（流式请求由LiteLLM路由到astreaming）
+            stream = False
             
-            print(f'[custom_handler] async messages: {messages}')
-            # 确保messages是数组格式
-            if not isinstance(messages, list):
-                print(f"[custom_handler] 警告：messages不是数组格式，类型为{type(messages)}，转换为数组")
-                if isinstance(messages, str):
-                    messages = [{"role": "user", "content": messages}]
-                elif messages is None:
-                    messages = []
-                else:
-                    messages = [{"role": "user", "content": str(messages)}]
-            
-            print(f"[custom_handler] 处理async completion请求: model={model}, messages={len(messages)}条消息, stream={stream}")
+            logger.debug("[custom_handler] async messages: %s", messages)
             
-            # 提取response_format并确定响应类型
-            response_format, response_type = self._extract_response_format(kwargs, "response_format")
-            messages.append({"role": "response_format", "content": response_format})
+            logger.debug("[custom_handler] 处理async completion请求: model=%s, messages=%d条消息, stream=%s", model, len(messages), stream)
             
             # 构建业务API请求
-            business_request = {
-                "query": messages,  # 全量转发完整的messages数组
-                "model_info": {
-                    "name": model
-                },
-                "response_type": response_type,
-                "stream": stream,
-                "temperature": temperature,
-                "max_tokens": max_tokens
-            }
+            business_request = self._build_business_request(kwargs, messages, stream)
+            cache_key = self._cache_key(business_request, messages)
+            cached = self._cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                logger.info("[custom_handler] acompletion命中响应缓存: model=%s", model)
+                return self._build_model_response(model, cached)
             
-            print(f"[custom_handler] 发送到业务API的异步请求: {json.dumps(business_request, ensure_ascii=False, indent=2)}")
+            logger.debug("[custom_handler] 发送到业务API的异步请求: %s", business_request)
             
-            # 使用aiohttp进行异步请求
-            import aiohttp
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    self.api_base,
-                    json=business_request,
-                    headers={"Content-Type": "application/json"},
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
-                    if response.status == 200:
-                        business_response = await response.json()
-                        print(f"[custom_handler] 业务API异步响应: {json.dumps(business_response, ensure_ascii=False, indent=2)}")
-                        
-                        # 修复：正确提取content字段
-                        content = business_response.get("content", "Hello from custom LLM!")
-                        if isinstance(content, dict) and "message" in content:
-                            # 提取message字段中的JSON字符串
-                            mock_response = content["message"]
-                            print(f"[custom_handler] 提取到JSON内容: {mock_response[:100]}...")
-                        else:
-                            # 如果不是预期格式，直接使用content
-                            mock_response = content if isinstance(content, str) else str(content)
-                            print(f"[custom_handler] 使用原始内容: {mock_response}")
-                        
-                        # 确保mock_response不为空
-                        if not mock_response or mock_response.strip() == "":
-                            mock_response = "Hello from custom LLM! (业务API返回空内容)"
-                            print(f"[custom_handler] 业务API返回空内容，使用默认响应: {mock_response}")
-                        
-                        return litellm.completion(
-                            model="gpt-3.5-turbo",  # 使用一个已知的模型格式
-                            messages=messages,  # 使用完整的messages数组
-                            mock_response=mock_response,
-                            api_key="dummy-key",  # 添加api_key参数
-                        )
-                    else:
-                        error_text = await response.text()
-                        print(f"[custom_handler] 业务API错误: {response.status} - {error_text}")
-                        # 返回错误响应
-                        return litellm.completion(
-                            model="gpt-3.5-turbo",
-                            messages=messages,  # 使用完整的messages数组
-                            mock_response="抱歉，服务暂时不可用。",
-                            api_key="dummy-key",  # 添加api_key参数
-                        )
+            # 使用复用的aiohttp会话进行异步请求（开启微批处理时合并发送）
+            if self._batch_window_ms > 0 and self._batch_supported:
+                business_response = await self._submit_batched(business_request)
+            else:
+                business_response = await self._apost_business_request(business_request)
+
+            if business_response is not None:
+                logger.debug("[custom_handler] 业务API异步响应: %s", business_response)
+                mock_response = self._parse_business_response(business_response)
+                # 业务API未返回有效内容时的默认文本不写入缓存
+                if cache_key is not None and mock_response not in _FALLBACK_RESPONSES:
+                    self._cache.set(cache_key, mock_response)
+                
+                return self._build_model_response(model, mock_response)
+            else:
+                # 返回错误响应
+                return self._build_model_response(model, "抱歉，服务暂时不可用。")
                         
         except Exception as e:
-            print(f"[custom_handler] 处理async completion请求时出错: {str(e)}")
-            # 确保messages是数组格式
-            if 'messages' in locals():
-                if not isinstance(messages, list):
-                    if isinstance(messages, str):
-                        messages = [{"role": "user", "content": messages}]
-                    elif messages is None:
-                        messages = []
-                    else:
-                        messages = [{"role": "user", "content": str(messages)}]
-            else:
-                messages = []
-            
+            logger.error("[custom_handler] 处理async completion请求时出错: %s", e)
             # 返回错误响应
-            return litellm.completion(
-                model="gpt-3.5-turbo",
-                messages=messages,  # 使用完整的messages数组
-                mock_response="抱歉，处理请求时出现错误。",
-                api_key="dummy-key",  # 添加api_key参数
-            )
+            return self._build_model_response(model, "抱歉，处理请求时出现错误。")
 
     def streaming(self, *args, **kwargs) -> Iterator[GenericStreamingChunk]:
         """
         同步流式处理方法
-        根据官方文档实现
+        在后台事件循环上驱动astreaming()，与异步路径共用同一套请求与SSE解析逻辑
         """
+        loop = _get_background_loop()
+        agen = self.astreaming(*args, **kwargs)
         try:
-            # 从kwargs中提取参数
-            model = kwargs.get("model", "business-api")
-            messages = kwargs.get("messages", [])
-            max_tokens = kwargs.get("max_tokens", 100)
-            temperature = kwargs.get("temperature", 0.7)
-            
-            print(f'[custom_handler] streaming messages: {messages}')
-            # 确保messages是数组格式
-            if not isinstance(messages, list):
-                if isinstance(messages, str):
-                    messages = [{"role": "user", "content": messages}]
-                elif messages is None:
-                    messages = []
-                else:
-                    messages = [{"role": "user", "content": str(messages)}]
-            
-            print(f"[custom_handler] 处理streaming请求: model={model}, messages={len(messages)}条消息")
-            
-            # 提取response_format并确定响应类型
-            response_format, response_type = self._extract_response_format(kwargs, "response_format")
-            messages.append({"role": "response_format", "content": response_format})
-            
-            # 构建业务API请求
-            business_request = {
-                "query": messages,  # 全量转发完整的messages数组
-                "model_info": {
-                    "name": model
-                },
-                "response_type": response_type,
-                "stream": True,  # 强制设置为流式
-                "temperature": temperature,
-                "max_tokens": max_tokens
-            }
-            
-            print(f"[custom_handler] 发送到业务API的同步流式请求: {json.dumps(business_request, ensure_ascii=False, indent=2)}")
-
-            # 启动流式保存器（封装）
-            stream_saver, enable_stream_save, _resp_id = self.init_start_dify_stream_saver(
-                query_messages=messages,
-                filename_prefix="litellm_custom",
-                response_id=f"custom-sync-{uuid.uuid4().hex[:10]}",
-                enable_stream_save=True,
-            )
-            
-            # 使用requests进行同步请求
-            import requests
-            
-            try:
-                response = requests.post(
-                    self.api_base,
-                    json=business_request,
-                    headers={"Content-Type": "application/json"},
-                    timeout=60,
-                    stream=True
-                )
-                
-                if response.status_code == 200:
-                    # 处理流式响应 - 逐个返回每个SSE数据块
-                    chunk_count = 0
-                    for line in response.iter_lines(decode_unicode=True):
-                        if line:
-                            chunk_count += 1
-                            print(f"[custom_handler] 🔄 STREAMING 第{chunk_count}个数据块: {line[:100]}...")
-                                # 边流边保存原始SSE行
-                            self.save_stream_chunk(stream_saver, enable_stream_save, line)
-                            
-                            # 解析SSE数据
-                            if line.startswith('data: '):
-                                try:
-                                    # 移除 "data: " 前缀
-                                    data_content = line[6:].strip()  # 移除 "data: " 前缀并去除空白
-                                    
-                                    if data_content == '[DONE]':
-                                        # 流结束
-                                        print(f"[custom_handler] 🏁 STREAMING 流结束信号")
-                                        final_chunk: GenericStreamingChunk = {
-                                            "finish_reason": "stop",
-                                            "index": 0,
-                                            "is_finished": True,
-                                            "text": "",
-                                            "tool_use": None,
-                                            "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                                        }
-                                        yield final_chunk
-                                        break
-                                    else:
-                                        # 尝试解析外层JSON数据（Dify的嵌套格式）
-                                        try:
-                                            outer_data = json.loads(data_content)
-                                            
-                                            # 检查是否是Dify的嵌套格式
-                                            if isinstance(outer_data, dict) and "type" in outer_data and "chunk" in outer_data:
-                                                # 这是Dify的嵌套格式，需要解析内层的chunk
-                                                chunk_content = outer_data.get("chunk", "")
-                                                if chunk_content:
-                                                    # 解析内层的chunk内容
-                                                    try:
-                                                        inner_data = json.loads(chunk_content)
-                                                        text_content = self._extract_text_from_sse_data(inner_data)
-                                                        if text_content == "__WORKFLOW_FINISHED__":
-                                                            print(f"[custom_handler] 🏁 STREAMING 工作流完成(修复后)")
-                                                            final_chunk: GenericStreamingChunk = {
-                                                                "finish_reason": "stop",
-                                                                "index": 0,
-                                                                "is_finished": True,
-                                                                "text": "",
-                                                                "tool_use": None,
-                                                                "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                                                            }
-                                                            yield final_chunk
-                                                            return
-                                                        elif text_content:
-                                                            print(f"[custom_handler] 📤 STREAMING Yielding text_chunk内容(修复后): {text_content[:50]}...")
-                                                            generic_streaming_chunk: GenericStreamingChunk = {
-                                                                "finish_reason": None,
-                                                                "index": 0,
-                                                                "is_finished": False,
-                                                                "text": text_content,
-                                                                "tool_use": None,
-                                                                "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                                                            }
-                                                            yield generic_streaming_chunk
-                                                        else:
-                                                            print(f"[custom_handler] ⚠️ STREAMING text_chunk内容为空，跳过")
-                                                            
-                                                    except json.JSONDecodeError as inner_e:
-                                                        # 内层JSON解析失败，可能是部分数据或单引号格式
-                                                        print(f"[custom_handler] ⚠️ 内层JSON解析失败: {str(inner_e)}, chunk内容: {chunk_content[:100]}...")
-                                                        # 尝试处理单引号格式
-                                                        try:
-                                                            # 替换单引号为双引号
-                                                            chunk_content_fixed = chunk_content.replace("'", '"')
-                                                            inner_data = json.loads(chunk_content_fixed)
-                                                            text_content = self._extract_text_from_sse_data(inner_data)
-                                                            if text_content:
-                                                                print(f"[custom_handler] 📤 STREAMING Yielding text_chunk内容(修复后): {text_content[:50]}...")
-                                                                generic_streaming_chunk: GenericStreamingChunk = {
-                                                                    "finish_reason": None,
-                                                                    "index": 0,
-                                                                    "is_finished": False,
-                                                                    "text": text_content,
-                                                                    "tool_use": None,
-                                                                    "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                                                                }
-                                                                yield generic_streaming_chunk
-                                                        except:
-                                                            continue
-                                            else:
-                                                # 不是Dify的嵌套格式，按原来的方式处理
-                                                text_content = self._extract_text_from_sse_data(outer_data)
-                                                if text_content == "__WORKFLOW_FINISHED__":
-                                                    print(f"[custom_handler] 🏁 STREAMING 工作流完成(修复后外层)")
-                                                    final_chunk: GenericStreamingChunk = {
-                                                        "finish_reason": "stop",
-                                                        "index": 0,
-                                                        "is_finished": True,
-                                                        "text": "",
-                                                        "tool_use": None,
-                                                        "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                                                    }
-                                                    yield final_chunk
-                                                    return
-                                                elif text_content:
-                                                    print(f"[custom_handler] 📤 STREAMING Yielding内容(修复后): {text_content[:50]}...")
-                                                    generic_streaming_chunk: GenericStreamingChunk = {
-                                                        "finish_reason": None,
-                                                        "index": 0,
-                                                        "is_finished": False,
-                                                        "text": text_content,
-                                                        "tool_use": None,
-                                                        "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                                                    }
-                                                    yield generic_streaming_chunk
-                                                else:
-                                                    print(f"[custom_handler] ⚠️ STREAMING 直接内容为空，跳过")
-                                                    
-                                        except json.JSONDecodeError as outer_e:
-                                            # 外层JSON解析失败，可能是部分数据或其他格式
-                                            print(f"[custom_handler] ⚠️ 外层JSON解析失败: {str(outer_e)}, 原始内容: {data_content[:100]}...")
-                                            # 尝试处理单引号格式
-                                            try:
-                                                # 替换单引号为双引号
-                                                data_content_fixed = data_content.replace("'", '"')
-                                                outer_data = json.loads(data_content_fixed)
-                                                text_content = self._extract_text_from_sse_data(outer_data)
-                                                if text_content:
-                                                    print(f"[custom_handler] 📤 STREAMING Yielding内容(修复后): {text_content[:50]}...")
-                                                    generic_streaming_chunk: GenericStreamingChunk = {
-                                                        "finish_reason": None,
-                                                        "index": 0,
-                                                        "is_finished": False,
-                                                        "text": text_content,
-                                                        "tool_use": None,
-                                                        "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                                                    }
-                                                    yield generic_streaming_chunk
-                                            except:
-                                                continue
-                                            
-                                except Exception as e:
-                                    # 如果整体解析失败，记录错误但继续处理
-                                    print(f"[custom_handler] ⚠️ SSE解析异常: {str(e)}, 行内容: {line[:100]}...")
-                                    continue
-                    
-                    # 确保发送完成信号
-                    print(f"[custom_handler] 🏁 STREAMING 发送最终完成信号，总共处理了{chunk_count}个数据块")
-                    final_chunk: GenericStreamingChunk = {
-                        "finish_reason": "stop",
-                        "index": 0,
-                        "is_finished": True,
-                        "text": "",
-                        "tool_use": None,
-                        "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                    }
-                    yield final_chunk
-                else:
-                    error_text = response.text
-                    print(f"[custom_handler] 业务API返回错误: {response.status_code} - {error_text}")
-                    # 发送错误块
-                    error_chunk: GenericStreamingChunk = {
-                        "finish_reason": "stop",
-                        "index": 0,
-                        "is_finished": True,
-                        "text": f"业务API错误: {response.status_code} - {error_text}",
-                        "tool_use": None,
-                        "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                    }
-                    yield error_chunk
-                    
-            except Exception as e:
-                error_msg = f"请求业务API失败: {str(e)}"
-                print(f"[custom_handler] {error_msg}")
-                # 发送错误块
-                error_chunk: GenericStreamingChunk = {
-                    "finish_reason": "stop",
-                    "index": 0,
-                    "is_finished": True,
-                    "text": f"请求失败: {error_msg}",
-                    "tool_use": None,
-                    "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                }
-                yield error_chunk
-                
-        except Exception as e:
-            err_text = f"同步流式处理失败: {e}"
-            print(f"❌ [custom_handler] {err_text}")
-            logger.error(f"❌ [custom_handler] {err_text}")
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(agen.__anext__(), loop).result()
+                except StopAsyncIteration:
+                    return
         finally:
-            # 收尾保存器
-            try:
-                if enable_stream_save and stream_saver is not None:
-                    stream_saver.set_final_stats(chunk_count=locals().get('chunk_count', 0), processing_time=0.0)
-                    stream_saver.close()
-            except Exception:
-                pass
-            # 仅在异常路径上发送错误块
-            if 'err_text' in locals():
-                error_chunk: GenericStreamingChunk = {
-                    "finish_reason": "stop",
-                    "index": 0,
-                    "is_finished": True,
-                    "text": err_text,
-                    "tool_use": None,
-                    "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                }
-                yield error_chunk
+            # 调用方提前停止迭代时，在后台循环上关闭异步生成器，释放连接与保存器
+            asyncio.run_coroutine_threadsafe(agen.aclose(), loop).result()
 
     async def astreaming(self, *args, **kwargs) -> AsyncIterator[GenericStreamingChunk]:
         """
         异步流式处理方法
         使用真正的异步流式读取，保持即时处理
         """
+        # 收尾阶段用到的状态预先初始化，finally中直接引用
+        stream_saver = None
+        enable_stream_save = False
+        stats: Dict[str, int] = {"chunk_count": 0}
+        err_text: Optional[str] = None
         try:
             # 从kwargs中提取参数
             model = kwargs.get("model", "business-api")
-            messages = kwargs.get("messages", [])
-            max_tokens = kwargs.get("max_tokens", 100)
-            temperature = kwargs.get("temperature", 0.7)
+            messages = _normalize_messages(kwargs.get("messages", []))
             
-            print(f'[custom_handler] async streaming messages: {messages}')
-            # 确保messages是数组格式
-            if not isinstance(messages, list):
-                if isinstance(messages, str):
-                    messages = [{"role": "user", "content": messages}]
-                elif messages is None:
-                    messages = []
-                else:
-                    messages = [{"role": "user", "content": str(messages)}]
-            
-            print(f"[custom_handler] 处理async streaming请求: model={model}, messages={len(messages)}条消息")
-            
-            # 提取response_format并确定响应类型
-            response_format, response_type = self._extract_response_format(kwargs, "response_format")
-            messages.append({"role": "response_format", "content": response_format})
+            logger.debug("[custom_handler] async streaming messages: %s", messages)
+            logger.debug("[custom_handler] 处理async streaming请求: model=%s, messages=%d条消息", model, len(messages))
             
-            # 构建业务API请求
-            business_request = {
-                "query": messages,  # 全量转发完整的messages数组
-                "model_info": {
-                    "name": model
-                },
-                "response_type": response_type,
-                "stream": True,  # 强制设置为流式
-                "temperature": temperature,
-                "max_tokens": max_tokens
-            }
-            
-            print(f"[custom_handler] 发送到业务API的异步流式请求: {json.dumps(business_request, ensure_ascii=False, indent=2)}")
-
-            # 启动流式保存器（封装）
-            stream_saver, enable_stream_save, _resp_id = self.init_start_dify_stream_saver(
-                query_messages=messages,
-                filename_prefix="litellm_custom",
-                response_id=f"custom-async-{uuid.uuid4().hex[:10]}",
-                enable_stream_save=True,
-            )
+            # 构建业务API请求（与completion/acompletion共用，强制设置为流式）
+            business_request = self._build_business_request(kwargs, messages, True)
             
-            # 使用aiohttp进行异步请求
-            import aiohttp
+            logger.debug("[custom_handler] 发送到业务API的异步流式请求: %s", business_request)
+
+            # 启动流式保存器（封装）；未开启 DIFY_ENABLE_STREAM_SAVE 时不创建文件与写线程
+            if is_stream_save_enabled_by_env is not None and is_stream_save_enabled_by_env():
+                stream_saver, enable_stream_save, _resp_id = self.init_start_dify_stream_saver(
+                    query_messages=business_request["query"],
+                    filename_prefix="litellm_custom",
+                    response_id=f"custom-async-{os.urandom(5).hex()}",
+                    enable_stream_save=True,
+                )
             
+            # 使用复用的aiohttp会话进行异步请求（请求头由会话提供，读取间隔超时放宽到60秒）
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        self.api_base,
-                        json=business_request,
-                        headers={"Content-Type": "application/json"},
-                        timeout=aiohttp.ClientTimeout(total=60)
-                    ) as response:
-                        
-                        if response.status == 200:
-                            # 提取为独立方法，提升可读性与复用性
-                            stats: Dict[str, int] = {"chunk_count": 0}
-                            async for generic_chunk in self._async_parse_standard_sse_to_generic_chunks(
-                                response=response,
-                                stream_saver=stream_saver,
-                                enable_stream_save=enable_stream_save,
-                                stats=stats,
-                            ):
+                session = await self._get_aiohttp_session()
+                async with session.post(
+                    self.api_base,
+                    data=_json_dumps(business_request),
+                    timeout=self._stream_timeout,
+                ) as response:
+                    
+                    if response.status == 200:
+                        # 提取为独立方法，提升可读性与复用性；
+                        # 调用方提前关闭时先关闭解析生成器，使其finally中的统计先于保存器收尾
+                        async with contextlib.aclosing(self._async_parse_standard_sse_to_generic_chunks(
+                            response=response,
+                            stream_saver=stream_saver,
+                            enable_stream_save=enable_stream_save,
+                            stats=stats,
+                        )) as generic_chunks:
+                            async for generic_chunk in generic_chunks:
                                 yield generic_chunk
-                        else:
-                            error_text = await response.text()
-                            print(f"[custom_handler] 业务API返回错误: {response.status} - {error_text}")
-                            # 发送错误块
-                            error_chunk: GenericStreamingChunk = {
-                                "finish_reason": "stop",
-                                "index": 0,
-                                "is_finished": True,
-                                "text": f"业务API错误: {response.status} - {error_text}",
-                                "tool_use": None,
-                                "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                            }
-                            yield error_chunk
-                            
+                    else:
+                        error_text = await response.text()
+                        logger.warning("[custom_handler] 业务API返回错误: %s - %s", response.status, error_text)
+                        # 发送错误块
+                        yield _make_stop_chunk(f"业务API错误: {response.status} - {error_text}")
+                        
             except Exception as e:
                 error_msg = f"请求业务API失败: {str(e)}"
-                print(f"[custom_handler] {error_msg}")
+                logger.error("[custom_handler] %s", error_msg)
                 # 发送错误块
-                error_chunk: GenericStreamingChunk = {
-                    "finish_reason": "stop",
-                    "index": 0,
-                    "is_finished": True,
-                    "text": f"请求失败: {error_msg}",
-                    "tool_use": None,
-                    "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                }
-                yield error_chunk
+                yield _make_stop_chunk(f"请求失败: {error_msg}")
                 
         except Exception as e:
             err_text = f"异步流式处理失败: {e}"
-            print(f"❌ [custom_handler] {err_text}")
-            logger.error(f"❌ [custom_handler] {err_text}")
+            logger.error("❌ [custom_handler] %s", err_text)
         finally:
             # 收尾保存器
             try:
                 if enable_stream_save and stream_saver is not None:
-                    # 优先使用统计字典中的chunk_count
-                    _stats = locals().get('stats', {}) if isinstance(locals().get('stats', {}), dict) else {}
-                    final_count = _stats.get('chunk_count', 0)
-                    stream_saver.set_final_stats(chunk_count=final_count, processing_time=0.0)
+                    # 使用统计字典中的chunk_count
+                    stream_saver.set_final_stats(chunk_count=stats.get("chunk_count", 0), processing_time=0.0)
                     stream_saver.close()
             except Exception:
                 pass
             # 仅在异常路径上发送错误块
-            if 'err_text' in locals():
-                error_chunk: GenericStreamingChunk = {
-                    "finish_reason": "stop",
-                    "index": 0,
-                    "is_finished": True,
-                    "text": err_text,
-                    "tool_use": None,
-                    "usage": {"completion_tokens": 0, "prompt_tokens": 0, "total_tokens": 0},
-                }
-                yield error_chunk
+            if err_text is not None:
+                yield _make_stop_chunk(err_text)
 
     def _extract_text_from_sse_data(self, sse_data: dict) -> str:
         """
@@ -1071,47 +1098,27 @@ class MyCustomLLM(CustomLLM):
         """
         if not isinstance(sse_data, dict):
             return ""
-        
-        # 处理text_chunk事件
-        if sse_data.get("event") == "text_chunk":
-            text_content = sse_data.get("data", {}).get("text", "")
-            if text_content:
-                return text_content
-        
-        # 处理workflow_finished事件
-        elif sse_data.get("event") == "workflow_finished":
-            # 工作流完成，返回特殊标记
-            return "__WORKFLOW_FINISHED__"
-        
-        # 处理Dify的chunk事件（直接返回chunk内容）
-        elif sse_data.get("type") == "chunk":
-            chunk_content = sse_data.get("chunk", "")
-            if chunk_content:
-                return chunk_content
-        
-        # 处理Dify的status事件（记录但不返回内容）
-        elif sse_data.get("type") == "status":
-            status_message = sse_data.get("status", "")
-            print(f"[custom_handler] 📊 状态更新: {status_message}")
-            return ""  # 状态事件不返回内容
-        
-        # 处理Dify的complete事件
-        elif sse_data.get("type") == "complete":
-            print(f"[custom_handler] 🏁 收到完成事件")
-            return "__WORKFLOW_FINISHED__"
-        
-        # 处理其他事件类型（node_started, node_finished等）
-        elif sse_data.get("event") in ["node_started", "node_finished", "workflow_started"]:
-            # 这些事件不包含文本内容，返回空字符串
+
+        # 先按event、再按type查表分发；event 优先级高于 type，与原 if/elif 顺序一致
+        event = sse_data.get("event")
+        handler = _SSE_EVENT_HANDLERS.get(event)
+        if handler is None:
+            handler = _SSE_TYPE_HANDLERS.get(sse_data.get("type"))
+        if handler is not None:
+            return handler(sse_data)
+
+        # 其他事件类型（node_started, node_finished等）不包含文本内容
+        if event in _SSE_SILENT_EVENTS:
             return ""
-        
+
         # 如果不是事件格式，尝试直接提取text或content字段
-        else:
-            text_content = sse_data.get("text", "") or sse_data.get("content", "")
-            if text_content:
-                return text_content
-        
-        return ""
+        return sse_data.get("text", "") or sse_data.get("content", "") or ""
+
+@functools.lru_cache(maxsize=1)
+def get_default_instance() -> MyCustomLLM:
+    """返回进程内唯一的MyCustomLLM实例（共享连接池与缓存）"""
+    return MyCustomLLM()
+
 
 # 创建实例
-my_custom_llm = MyCustomLLM()
+my_custom_llm = get_default_instance()
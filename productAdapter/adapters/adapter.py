@@ -10,7 +10,6 @@ import os
 import sys
 import time
 import uuid
-import json
 import logging
 import requests
 from typing import Dict, List, Any, Optional, Union, Generator
@@ -24,6 +23,9 @@ project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 setup_unified_logging(project_root)
 logger = logging.getLogger("litellm_adapter")
 
+# JSON序列化：与custom_handler共用同一套实现（优先orjson，未安装时回退到标准库）
+from productAdapter.utils.json_utils import json_dumps as _json_dumps, json_loads as _json_loads
+
 class LiteLLMAdapter:
     """LiteLLM适配器类"""
     
@@ -37,6 +39,14 @@ class LiteLLMAdapter:
         if self.api_key:
             headers["Authorization"] = f"Bearer {self.api_key}"
         return headers
+
+    @staticmethod
+    def _extract_user_query(messages: List[Dict[str, Any]]) -> str:
+        """从messages中单次倒序扫描，取最后一条用户消息内容"""
+        return next(
+            (msg.get("content", "") for msg in reversed(messages) if msg.get("role") == "user"),
+            ""
+        )
     
     def handle_chat_completion(self, openai_request: Dict[str, Any]) -> Dict[str, Any]:
         """
@@ -66,19 +76,13 @@ class LiteLLMAdapter:
                     user_query = str(prompt)
             elif messages:
                 # 从messages中提取用户消息
-                for msg in reversed(messages):
-                    if msg.get("role") == "user":
-                        user_query = msg.get("content", "")
-                        break
+                user_query = self._extract_user_query(messages)
         else:
             # 直接传递的参数
             messages = openai_request.get("messages", [])
             if messages:
                 # 找到最后一条用户消息
-                for msg in reversed(messages):
-                    if msg.get("role") == "user":
-                        user_query = msg.get("content", "")
-                        break
+                user_query = self._extract_user_query(messages)
             
             # 如果没有找到用户消息，尝试从prompt字段提取
             if not user_query:
@@ -113,20 +117,23 @@ class LiteLLMAdapter:
         if "max_tokens" in kwargs:
             business_api_request["max_tokens"] = kwargs["max_tokens"]
         
-        logger.debug(f"转换后的业务API请求体: {json.dumps(business_api_request, ensure_ascii=False, indent=2)}")
+        # 请求体只序列化一次，调试日志直接复用这份bytes
+        body = _json_dumps(business_api_request)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("转换后的业务API请求体: %s", body.decode("utf-8"))
 
         # 3. 向你的业务API发送POST请求
         try:
             response = requests.post(
                 self.api_base, # 完整的API端点
-                json=business_api_request,
+                data=body,
                 headers=self._get_headers(),
                 timeout=60 # 设置超时时间
             )
             response.raise_for_status()  # 如果状态码不是2xx，则抛出HTTPError
 
             # 4. 将业务API响应转换为LiteLLM期望的OpenAI格式
-            business_response = response.json()
+            business_response = _json_loads(response.content)
             content = business_response.get("content")
 
             # 构造OpenAI兼容的响应格式
@@ -156,5 +163,5 @@ class LiteLLMAdapter:
 
         except requests.exceptions.RequestException as e:
             # 处理网络或HTTP错误
-            logger.error(f"请求业务API时发生错误: {e}")
+            logger.error("请求业务API时发生错误: %s", e)
             raise Exception(f"请求业务API时发生错误: {e}")
\ No newline at end of file
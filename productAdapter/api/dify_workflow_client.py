@@ -31,6 +31,9 @@ class DifyWorkflowClient:
     用于调用Dify平台的工作流API
     """
     
+    # messages角色 -> 工作流输入字段
+    _ROLE_INPUT_KEYS = {"system": "system", "user": "user", "response_format": "response_format"}
+
     # 类级别的配置
     _api_key = None
     _base_url = None
@@ -307,22 +310,17 @@ class DifyWorkflowClient:
         input_data = {}
         
         if isinstance(query, list):
-            # 如果是messages数组，提取不同角色的内容
-            system_content = ""
-            user_content = ""
-            response_format_content = None
-            
+            # 如果是messages数组，按角色查表提取内容（同一角色以最后一条为准）
+            role_input_keys = self._ROLE_INPUT_KEYS
+            collected: Dict[str, Any] = {}
             for msg in query:
                 if isinstance(msg, dict):
-                    role = msg.get("role", "")
-                    content = msg.get("content", "")
-                    
-                    if role == "system":
-                        system_content = content
-                    elif role == "user":
-                        user_content = content
-                    elif role == "response_format":
-                        response_format_content = content
+                    field = role_input_keys.get(msg.get("role", ""))
+                    if field is not None:
+                        collected[field] = msg.get("content", "")
+            system_content = collected.get("system", "")
+            user_content = collected.get("user", "")
+            response_format_content = collected.get("response_format")
             
             # 将提取的内容放入input_data
             if system_content:
@@ -664,19 +662,19 @@ class DifyWorkflowClient:
                         
                         # 直接转发Dify的SSE数据
                         chunk_count = 0
-                        # 按SSE事件分隔（以"\n\n"作为分隔符），先以字节读取再按编码解码，最后补回事件结束的双换行
-                        encoding = response.encoding or "utf-8"
+                        # 按SSE事件分隔（以"\n\n"作为分隔符），先以字节读取再解码，最后补回事件结束的双换行
+                        # SSE规范固定为UTF-8：直接解码，不使用requests推断的编码（text/* 无charset时会被当作ISO-8859-1）
+                        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+                        # 使用默认的小块读取：大块读取需等攒满整块才返回，会推迟SSE事件的下发
                         for event in response.iter_lines(decode_unicode=False, delimiter=b"\n\n"):
                             if not event:
                                 continue
-                            try:
-                                decoded_event = event.decode(encoding, errors="replace")
-                            except Exception:
-                                decoded_event = event.decode("utf-8", errors="replace")
+                            decoded_event = event.decode("utf-8", errors="replace")
                             chunk_count += 1
-                            logger.debug(
-                                f"[dify_workflow_client] 🔄 第{chunk_count}个事件: {json.dumps(decoded_event, ensure_ascii=True, indent=2)}"
-                            )
+                            if debug_enabled:
+                                logger.debug(
+                                    f"[dify_workflow_client] 🔄 第{chunk_count}个事件: {json.dumps(decoded_event, ensure_ascii=True, indent=2)}"
+                                )
                             # 还原SSE事件结束的分隔符，确保下游收到 "...\n\n"
                             yield f"{decoded_event}\n\n"
                         
@@ -226,6 +226,7 @@ class DifyStreamingFileWriter:
       writer = DifyStreamingFileWriter(response_id, query, project_root, filename_prefix)
       writer.start()
       writer.write(line)
+      writer.write_many(lines)  # 批量写入，每段仍按独立数据块记录
       ...
       writer.set_final_stats(chunk_count, processing_time)
       writer.close()  # 非阻塞，后台线程完成收尾
@@ -250,10 +251,11 @@ class DifyStreamingFileWriter:
         os.makedirs(logs_dir, exist_ok=True)
         self.file_path = os.path.join(logs_dir, f"{self.filename_prefix}_{self.timestamp}.txt")
 
-        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._queue: "queue.Queue[Optional[Any]]" = queue.Queue()
         self._thread: Optional[threading.Thread] = None
         self._chunk_index: int = 0
         self._final_stats: Dict[str, Any] = {}
+        self._closed: bool = False
 
     def start(self) -> None:
         if self._thread and self._thread.is_alive():
@@ -276,12 +278,14 @@ class DifyStreamingFileWriter:
                         item = self._queue.get()
                         if item is None:
                             break
-                        self._chunk_index += 1
-                        f.write(f"## 数据块 {self._chunk_index}\n")
-                        f.write(item)
-                        if not item.endswith("\n"):
+                        # write_many 入队的是列表：逐段写入，整批只 flush 一次
+                        for part in (item if isinstance(item, list) else (item,)):
+                            self._chunk_index += 1
+                            f.write(f"## 数据块 {self._chunk_index}\n")
+                            f.write(part)
+                            if not part.endswith("\n"):
+                                f.write("\n")
                             f.write("\n")
-                        f.write("\n")
                         f.flush()
 
                     # footer with stats
@@ -317,11 +321,26 @@ class DifyStreamingFileWriter:
             pass
 
     def write(self, line: str) -> None:
+        if self._closed:
+            # close() 之后入队的数据排在结束标记之后，不会再被写入文件
+            logger.warning(f"⚠️ 流式保存器已关闭，丢弃1段数据: {self.response_id}")
+            return
         try:
             self._queue.put_nowait(line)
         except Exception:
             pass
 
+    def write_many(self, lines: List[str]) -> None:
+        if not lines:
+            return
+        if self._closed:
+            logger.warning(f"⚠️ 流式保存器已关闭，丢弃{len(lines)}段数据: {self.response_id}")
+            return
+        try:
+            self._queue.put_nowait(list(lines))
+        except Exception:
+            pass
+
     def set_final_stats(self, chunk_count: int = None, processing_time: float = None) -> None:
         if chunk_count is not None:
             self._final_stats["chunk_count"] = chunk_count
@@ -330,12 +349,18 @@ class DifyStreamingFileWriter:
 
     def close(self) -> None:
         # 非阻塞关闭，后台线程完成收尾
+        self._closed = True
         try:
             self._queue.put_nowait(None)
         except Exception:
             pass
 
 
+def is_stream_save_enabled_by_env() -> bool:
+    """读取环境变量 DIFY_ENABLE_STREAM_SAVE（1/true/yes 视为开启），默认关闭。"""
+    return os.getenv("DIFY_ENABLE_STREAM_SAVE", "0").lower() in ["1", "true", "yes"]
+
+
 def start_dify_stream_saver(
     response_id: str,
     query: Any,
@@ -354,7 +379,7 @@ def start_dify_stream_saver(
     """
     if enable_stream_save is None:
         if use_env:
-            enable_stream_save = os.getenv("DIFY_ENABLE_STREAM_SAVE", "0").lower() in ["1", "true", "yes"]
+            enable_stream_save = is_stream_save_enabled_by_env()
         else:
             enable_stream_save = False
 
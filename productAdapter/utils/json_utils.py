@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+JSON序列化工具模块
+优先使用orjson（直接产出/解析bytes），未安装时回退到标准库；
+custom_handler 与 adapter 共用同一套实现，保证两条路径的请求体编码一致
+"""
+
+import json
+from typing import Any
+
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    json_loads = orjson.loads
+except ImportError:  # 兜底，未安装orjson时使用标准库
+    orjson = None  # type: ignore
+
+    def json_dumps(obj: Any) -> bytes:
+        # 线上传输使用紧凑格式；默认ensure_ascii输出纯ASCII，走标准库的快速编码路径
+        return json.dumps(obj, separators=(",", ":")).encode("ascii")
+
+    json_loads = json.loads
+
+__all__ = ["json_dumps", "json_loads"]
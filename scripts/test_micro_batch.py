@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+本地测试 custom_handler 微批处理的脚本（不依赖业务API）
+
+用法:
+  python scripts/test_micro_batch.py
+
+说明:
+- 窗口期内到达的请求按max_tokens档位（<=128、<=512、>512）分别成批
+- 档位内达到批量上限时立即发送，并撤销该档位的定时刷新
+- 批量请求返回非200（限流、5xx等）时仅本批次退回逐条请求，后续仍继续批量
+- 批量请求返回200但结构不符时，后续退回逐条请求模式
+"""
+
+import asyncio
+import json
+import os
+import sys
+
+# 确保可以从项目根目录导入 custom_handler
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from custom_handler import MyCustomLLM
+
+
+failures: list[str] = []
+
+
+def check(name: str, ok: bool) -> None:
+    print(f"[test] {'✅' if ok else '❌'} {name}")
+    if not ok:
+        failures.append(name)
+
+
+class FakeResponse:
+    def __init__(self, status: int, payload) -> None:
+        self.status = status
+        self._body = json.dumps(payload).encode("utf-8")
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def json(self, content_type=None):
+        return json.loads(self._body)
+
+    async def text(self) -> str:
+        return self._body.decode("utf-8")
+
+    async def __aenter__(self) -> "FakeResponse":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        return None
+
+
+class FakeSession:
+    """模拟业务API：批量请求依次使用 batch_statuses 中的状态码，单条请求总是成功。"""
+
+    def __init__(self, batch_statuses=(), batch_shape_ok: bool = True) -> None:
+        self.batch_statuses = list(batch_statuses)
+        self.batch_shape_ok = batch_shape_ok
+        self.batch_posts: list[list[int]] = []
+        self.single_posts = 0
+
+    def post(self, url, **kwargs) -> FakeResponse:
+        body = kwargs["json"] if kwargs.get("json") is not None else json.loads(kwargs["data"])
+        if "batch" in body:
+            self.batch_posts.append([req["max_tokens"] for req in body["batch"]])
+            status = self.batch_statuses.pop(0) if self.batch_statuses else 200
+            if status != 200:
+                return FakeResponse(status, {"detail": "busy"})
+            if not self.batch_shape_ok:
+                return FakeResponse(200, {"detail": "single request schema"})
+            return FakeResponse(200, {"batch": [{"content": str(req["max_tokens"])} for req in body["batch"]]})
+        self.single_posts += 1
+        return FakeResponse(200, {"content": str(body["max_tokens"])})
+
+
+def make_llm(window_ms: int, max_size: int, session: FakeSession) -> MyCustomLLM:
+    llm = MyCustomLLM()
+    llm._batch_window_ms = window_ms
+    llm._batch_max_size = max_size
+
+    async def fake_session():
+        return session
+
+    llm._get_aiohttp_session = fake_session
+    return llm
+
+
+async def submit(llm: MyCustomLLM, max_tokens: int) -> str:
+    business_request = {"query": [{"role": "user", "content": f"q{max_tokens}"}], "max_tokens": max_tokens}
+    response = await llm._submit_batched(business_request)
+    return response["content"]
+
+
+async def run_bin_checks() -> None:
+    session = FakeSession()
+    llm = make_llm(window_ms=20, max_size=16, session=session)
+    max_tokens_list = [50, 300, 2000, 60, 400, 3000]
+    results = await asyncio.gather(*(submit(llm, mt) for mt in max_tokens_list))
+
+    check("结果按请求顺序返回", results == [str(mt) for mt in max_tokens_list])
+    check("按max_tokens档位分为3批", sorted(session.batch_posts) == [[50, 60], [300, 400], [2000, 3000]])
+    check("刷新后无遗留队列与定时任务", not llm._pending and not llm._flush_tasks)
+
+
+async def run_early_flush_checks() -> None:
+    # 窗口设为10秒：只有按数量提前刷新才能在超时前返回
+    session = FakeSession()
+    llm = make_llm(window_ms=10000, max_size=2, session=session)
+    results = await asyncio.wait_for(asyncio.gather(submit(llm, 10), submit(llm, 20)), timeout=2)
+
+    check("达到批量上限时立即发送", results == ["10", "20"] and session.batch_posts == [[10, 20]])
+    check("提前刷新后撤销定时刷新", not llm._flush_tasks)
+
+
+async def run_error_status_checks() -> None:
+    session = FakeSession(batch_statuses=[500])
+    llm = make_llm(window_ms=20, max_size=16, session=session)
+
+    first = await asyncio.gather(submit(llm, 10), submit(llm, 20))
+    check("批量请求返回500时本批次逐条重发", first == ["10", "20"] and session.single_posts == 2)
+    check("批量请求返回500后仍保持批量模式", llm._batch_supported)
+
+    second = await asyncio.gather(submit(llm, 30), submit(llm, 40))
+    check(
+        "后续批次继续批量发送",
+        second == ["30", "40"] and session.batch_posts == [[10, 20], [30, 40]] and session.single_posts == 2,
+    )
+
+
+async def run_wrong_shape_checks() -> None:
+    session = FakeSession(batch_shape_ok=False)
+    llm = make_llm(window_ms=20, max_size=16, session=session)
+    results = await asyncio.gather(submit(llm, 10), submit(llm, 20))
+
+    check("批量响应结构不符时逐条重发", results == ["10", "20"] and session.single_posts == 2)
+    check("批量响应结构不符时关闭批量模式", not llm._batch_supported)
+
+
+async def run_all() -> None:
+    await run_bin_checks()
+    await run_early_flush_checks()
+    await run_error_status_checks()
+    await run_wrong_shape_checks()
+
+
+def main() -> int:
+    asyncio.run(run_all())
+    print(f"[test] 失败 {len(failures)} 项" if failures else "[test] 全部通过")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -97,10 +97,10 @@ class FakeContent:
         self._data = data
         self._chunk_size = chunk_size
 
-    async def iter_chunked(self, _n: int) -> AsyncIterator[bytes]:
-        # 忽略 _n, 使用我们自己的 chunk_size 切片
+    async def iter_chunks(self) -> AsyncIterator[tuple[bytes, bool]]:
+        # 与 aiohttp 一致返回 (data, end_of_http_chunk), 使用我们自己的 chunk_size 切片
         for i in range(0, len(self._data), self._chunk_size):
-            yield self._data[i : i + self._chunk_size]
+            yield self._data[i : i + self._chunk_size], True
 
 
 class FakeResponse:
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+本地测试 custom_handler 响应缓存的脚本（不依赖业务API）
+
+用法:
+  python scripts/test_response_cache.py
+
+说明:
+- 转发参数（max_tokens、response_format、消息的附加字段等）不同的请求不会互相命中
+- 字典键顺序不同但内容相同的请求命中同一缓存
+- content不可哈希（如多模态列表）的请求同样可以缓存
+- temperature > 0 的请求不缓存
+- 业务API返回空内容时使用的默认文本不写入缓存
+"""
+
+import asyncio
+import os
+import sys
+
+# 确保可以从项目根目录导入 custom_handler
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from custom_handler import MyCustomLLM, MemoryCacheBackend
+
+
+failures: list[str] = []
+
+
+def check(name: str, ok: bool) -> None:
+    print(f"[test] {'✅' if ok else '❌'} {name}")
+    if not ok:
+        failures.append(name)
+
+
+class RecordingLLM:
+    """替换业务API调用并记录实际发出的请求数。"""
+
+    def __init__(self, content: str = "ok") -> None:
+        self.llm = MyCustomLLM(cache_backend=MemoryCacheBackend(maxsize=16))
+        self.content = content
+        self.calls = 0
+
+        async def fake_post(business_request):
+            self.calls += 1
+            return {"content": self.content}
+
+        self.llm._apost_business_request = fake_post
+
+    async def ask(self, messages: list, **optional_params) -> str:
+        response = await self.llm.acompletion(
+            model="business-api", messages=messages, optional_params=optional_params
+        )
+        return response.choices[0].message.content
+
+
+def hi() -> list:
+    # 每次请求使用新的messages列表，避免请求之间共享同一对象
+    return [{"role": "user", "content": "hi"}]
+
+
+async def run_key_checks() -> None:
+    backend = RecordingLLM()
+
+    await backend.ask(hi(), temperature=0, max_tokens=10)
+    await backend.ask(hi(), temperature=0, max_tokens=10)
+    check("相同请求命中缓存", backend.calls == 1)
+
+    await backend.ask(hi(), temperature=0, max_tokens=20)
+    check("max_tokens不同不命中缓存", backend.calls == 2)
+
+    await backend.ask(hi(), temperature=0, max_tokens=10, response_format={"type": "json_object"})
+    check("response_format不同不命中缓存", backend.calls == 3)
+
+    await backend.ask(hi(), temperature=0.5, max_tokens=10)
+    await backend.ask(hi(), temperature=0.5, max_tokens=10)
+    check("temperature > 0 不缓存", backend.calls == 5)
+
+
+async def run_message_field_checks() -> None:
+    backend = RecordingLLM()
+
+    await backend.ask([{"role": "user", "content": "hi", "name": "a"}], temperature=0)
+    await backend.ask([{"role": "user", "content": "hi", "name": "b"}], temperature=0)
+    check("消息附加字段(name)不同不命中缓存", backend.calls == 2)
+
+    await backend.ask([{"name": "a", "content": "hi", "role": "user"}], temperature=0)
+    check("字典键顺序不影响缓存命中", backend.calls == 2)
+
+    multimodal = [{"role": "user", "content": [{"type": "text", "text": "hi"}]}]
+    await backend.ask(multimodal, temperature=0)
+    await backend.ask(multimodal, temperature=0)
+    check("content不可哈希的请求同样缓存", backend.calls == 3)
+
+
+async def run_fallback_checks() -> None:
+    backend = RecordingLLM(content="")
+
+    await backend.ask(hi(), temperature=0)
+    await backend.ask(hi(), temperature=0)
+    check("空内容默认文本不写入缓存", backend.calls == 2)
+
+    backend.content = "ok"
+    first = await backend.ask(hi(), temperature=0)
+    cached = await backend.ask(hi(), temperature=0)
+    check("有效内容写入缓存并命中", backend.calls == 3 and first == cached == "ok")
+
+
+async def run_all() -> None:
+    await run_key_checks()
+    await run_message_field_checks()
+    await run_fallback_checks()
+
+
+def main() -> int:
+    asyncio.run(run_all())
+    print(f"[test] 失败 {len(failures)} 项" if failures else "[test] 全部通过")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
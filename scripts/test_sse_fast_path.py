@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+本地测试 text_chunk 正则快速路径与完整JSON解析结果一致的脚本（不依赖业务API）
+
+用法:
+  python scripts/test_sse_fast_path.py
+
+说明:
+- _TEXT_CHUNK_RE 命中的负载，提取出的文本与 json.loads 结果一致
+- 含转义、附加字段等无法安全提取的负载不命中正则，交由JSON解析
+- 同一组 text_chunk 事件分别走快速路径与JSON路径时，解析器输出的文本序列一致
+"""
+
+import asyncio
+import json
+import os
+import sys
+from typing import AsyncIterator
+
+# 确保可以从项目根目录导入 custom_handler
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from custom_handler import MyCustomLLM, _TEXT_CHUNK_RE
+
+
+failures: list[str] = []
+
+TEXTS = ["Hello", " world", "世界", "", "tab\there", 'quote "x"', "back\\slash", "Hello", "end"]
+
+
+def check(name: str, ok: bool) -> None:
+    print(f"[test] {'✅' if ok else '❌'} {name}")
+    if not ok:
+        failures.append(name)
+
+
+class FakeContent:
+    def __init__(self, data: bytes, chunk_size: int = 7) -> None:
+        self._data = data
+        self._chunk_size = chunk_size
+
+    async def iter_chunks(self) -> AsyncIterator[tuple[bytes, bool]]:
+        for i in range(0, len(self._data), self._chunk_size):
+            yield self._data[i : i + self._chunk_size], True
+
+
+class FakeResponse:
+    def __init__(self, data: bytes) -> None:
+        self.content = FakeContent(data)
+
+
+def run_regex_checks() -> None:
+    matched = 0
+    mismatched: list[str] = []
+    for text in TEXTS:
+        for payload in (
+            json.dumps({"event": "text_chunk", "data": {"text": text}}, ensure_ascii=False),
+            json.dumps({"event": "text_chunk", "data": {"text": text}}, ensure_ascii=False, separators=(",", ":")),
+            json.dumps({"event": "text_chunk", "data": {"text": text}}),
+        ):
+            raw = payload.encode("utf-8")
+            match = _TEXT_CHUNK_RE.fullmatch(raw)
+            if match is None:
+                continue
+            matched += 1
+            if match.group(1).decode("utf-8") != json.loads(raw)["data"]["text"]:
+                mismatched.append(payload)
+    check(f"正则命中的负载与JSON解析一致（命中{matched}条，不一致{len(mismatched)}条）", matched > 0 and not mismatched)
+
+    for payload in (
+        '{"event": "text_chunk", "data": {"text": "a\\"b"}}',
+        '{"event": "text_chunk", "data": {"text": "\\u4e16"}}',
+        '{"event": "text_chunk", "data": {"text": "a", "extra": 1}}',
+        '{"event": "text_chunk", "data": {"text": "a"}, "task_id": "t"}',
+        '{"event": "message", "data": {"text": "a"}}',
+    ):
+        check(f"不应命中正则: {payload}", _TEXT_CHUNK_RE.fullmatch(payload.encode("utf-8")) is None)
+
+
+async def parse_texts(events: list[dict], **dumps_kwargs) -> list[str]:
+    blocks = [f"data: {json.dumps(ev, ensure_ascii=False, **dumps_kwargs)}\n\n" for ev in events]
+    blocks.append("data: [DONE]\n\n")
+    stats = {"chunk_count": 0, "event_count": 0}
+    chunks = [
+        chunk
+        async for chunk in MyCustomLLM()._async_parse_standard_sse_to_generic_chunks(
+            response=FakeResponse("".join(blocks).encode("utf-8")),
+            stream_saver=None,
+            enable_stream_save=False,
+            stats=stats,
+        )
+    ]
+    return [chunk["text"] for chunk in chunks]
+
+
+async def run_parser_checks() -> None:
+    fast = await parse_texts([{"event": "text_chunk", "data": {"text": t}} for t in TEXTS], separators=(",", ":"))
+    # data中附加字段使负载无法命中正则，全部走JSON解析
+    slow = await parse_texts([{"event": "text_chunk", "data": {"text": t, "seq": i}} for i, t in enumerate(TEXTS)])
+    check("快速路径与JSON路径输出的文本序列一致", fast == slow)
+    check("输出包含全部非空文本", "".join(fast) == "".join(TEXTS))
+
+
+def main() -> int:
+    run_regex_checks()
+    asyncio.run(run_parser_checks())
+    print(f"[test] 失败 {len(failures)} 项" if failures else "[test] 全部通过")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+本地测试流式响应提前关闭与SSE分帧的脚本（不依赖业务API）
+
+用法:
+  python scripts/test_stream_early_close.py
+
+说明:
+- _aiter_sse_blocks 在任意网络分片大小下切分出的事件块一致，提前关闭后不再读取后续数据
+- 同步 streaming() 提前关闭时，后台事件循环上的 astreaming() 生成器被关闭
+- astreaming() 提前关闭时，解析器的统计与批量写入先于流式保存器收尾
+"""
+
+import asyncio
+import os
+import sys
+from typing import AsyncIterator
+
+# 确保可以从项目根目录导入 custom_handler
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+if PROJECT_ROOT not in sys.path:
+    sys.path.insert(0, PROJECT_ROOT)
+
+from custom_handler import MyCustomLLM, _aiter_sse_blocks
+
+
+failures: list[str] = []
+
+SSE_DATA = (
+    b'event: ping\ndata: \n\n'
+    b'data: {"type": "chunk", "chunk": "Hel"}\n\n'
+    b': keepalive\n\n'
+    b'data: {"type": "chunk", "chunk": "lo"}\n\n'
+    b'\n\n'
+    b'data: {"type": "chunk", "chunk": "\xe4\xb8\x96\xe7\x95\x8c"}\n\n'
+    b'data: {"type": "complete"}'
+)
+
+
+def check(name: str, ok: bool) -> None:
+    print(f"[test] {'✅' if ok else '❌'} {name}")
+    if not ok:
+        failures.append(name)
+
+
+class FakeContent:
+    def __init__(self, data: bytes, chunk_size: int = 7) -> None:
+        self._data = data
+        self._chunk_size = chunk_size
+        self.read_bytes = 0
+
+    async def iter_chunks(self) -> AsyncIterator[tuple[bytes, bool]]:
+        for i in range(0, len(self._data), self._chunk_size):
+            chunk = self._data[i : i + self._chunk_size]
+            self.read_bytes += len(chunk)
+            yield chunk, True
+
+
+class FakeResponse:
+    status = 200
+
+    def __init__(self, data: bytes) -> None:
+        self.content = FakeContent(data)
+
+    async def __aenter__(self) -> "FakeResponse":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        return None
+
+
+class FakeSession:
+    def post(self, url, **kwargs) -> FakeResponse:
+        return FakeResponse(SSE_DATA)
+
+
+class RecordingSaver:
+    def __init__(self) -> None:
+        self.events: list[tuple] = []
+
+    def write(self, line: str) -> None:
+        self.events.append(("write", 1))
+
+    def write_many(self, lines: list) -> None:
+        self.events.append(("write_many", len(lines)))
+
+    def set_final_stats(self, chunk_count=None, processing_time=None) -> None:
+        self.events.append(("set_final_stats", chunk_count))
+
+    def close(self) -> None:
+        self.events.append(("close",))
+
+
+async def collect_blocks(chunk_size: int) -> list[bytes]:
+    return [block async for block in _aiter_sse_blocks(FakeContent(SSE_DATA, chunk_size))]
+
+
+async def run_framing_checks() -> None:
+    expected = [block.strip(b"\r\n") for block in SSE_DATA.split(b"\n\n") if block.strip(b"\r\n")]
+    results = [await collect_blocks(size) for size in range(1, len(SSE_DATA) + 1)]
+    check("任意分片大小切分出的事件块一致", all(blocks == expected for blocks in results))
+
+    content = FakeContent(SSE_DATA, chunk_size=8)
+    blocks = _aiter_sse_blocks(content)
+    first = await blocks.__anext__()
+    await blocks.aclose()
+    read_after_first = content.read_bytes
+    check("提前关闭后不再读取后续数据", first == expected[0] and read_after_first < len(SSE_DATA))
+
+
+def run_sync_bridge_checks() -> None:
+    llm = MyCustomLLM()
+    state = {"closed": False}
+
+    async def fake_astreaming(*args, **kwargs):
+        try:
+            for text in ("a", "b", "c"):
+                yield {"text": text}
+        finally:
+            state["closed"] = True
+
+    llm.astreaming = fake_astreaming
+    stream = llm.streaming(model="business-api", messages=[{"role": "user", "content": "hi"}])
+    first = next(stream)
+    stream.close()
+    check("同步streaming()提前关闭时关闭后台异步生成器", first["text"] == "a" and state["closed"])
+
+
+async def run_saver_order_checks() -> None:
+    os.environ["DIFY_ENABLE_STREAM_SAVE"] = "1"
+    llm = MyCustomLLM()
+    saver = RecordingSaver()
+
+    async def fake_session():
+        return FakeSession()
+
+    llm._get_aiohttp_session = fake_session
+    llm.init_start_dify_stream_saver = lambda **kwargs: (saver, True, "test")
+    stream = llm.astreaming(model="business-api", messages=[{"role": "user", "content": "hi"}])
+    texts = [(await stream.__anext__())["text"] for _ in range(2)]
+    await stream.aclose()
+
+    kinds = [event[0] for event in saver.events]
+    check("提前关闭前已收到两段文本", texts == ["Hel", "lo"])
+    check(
+        "批量写入先于保存器收尾",
+        "write_many" in kinds and kinds.index("write_many") < kinds.index("set_final_stats") < kinds.index("close"),
+    )
+    check("收尾统计包含已发送的数据块数", ("set_final_stats", 2) in saver.events)
+
+
+def main() -> int:
+    asyncio.run(run_framing_checks())
+    run_sync_bridge_checks()
+    asyncio.run(run_saver_order_checks())
+    print(f"[test] 失败 {len(failures)} 项" if failures else "[test] 全部通过")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())